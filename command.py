@@ -1,32 +1,39 @@
 # encoding: utf-8
 
 import sys
-import re
+import time
 import argparse
 from workflow.workflow import MATCH_ATOM, MATCH_STARTSWITH, MATCH_SUBSTRING, MATCH_ALL, MATCH_INITIALS, MATCH_CAPITALS, MATCH_INITIALS_STARTSWITH, MATCH_INITIALS_CONTAIN
 from workflow import Workflow, ICON_WEB, ICON_NOTE, ICON_BURN, ICON_SWITCH, ICON_HOME, ICON_COLOR, ICON_INFO, ICON_SYNC, web, PasswordNotFound
-from common import qnotify, error, st_api, get_device, get_scene, get_stored_data
+from common import HTTP_CACHE, PAGES, DEVICES_GENERATION, iter_stored_data, qnotify, error, st_api, st_api_pages, append_stored_data, get_device, get_scene, get_stored_data, lazy_stored_data, split_device_command
+from palette import get_color, build_color_index
+from index import get_device_capabilities, get_component_capabilities, store_index, record_usage
+from status import fetch_statuses
 
 log = None
 
 def get_devices(wf, api_key):
     """Retrieve all devices
 
-    Returns a has of devices.
+    Yields a list of devices per page.
 
     """
-    items = []
-    i = 0
-    while True:
-        result = st_api(wf, api_key, 'devices', dict(max=200, page=i))
-        if 'items' in result:
-            items.extend(result['items'])
-        if '_links' in result and 'next' in result['_links']:
-            i += 1
-        else:
-            break
+    return st_api_pages(wf, api_key, 'devices', dict(max=200), cache=True)
 
-    return items
+def sync_devices(wf, api_key):
+    """Store all devices, appending each page as it arrives
+
+    A sync that fails part way keeps the pages it got. The old devices stay until the first page is in.
+    The generation is bumped before the devices are rewritten, so the search index is rebuilt
+    from the devices that are stored even if the sync does not get to build it.
+
+    """
+    pages = get_devices(wf, api_key)
+    page = next(pages, [])
+    wf.store_data(DEVICES_GENERATION, time.time())
+    wf.store_data('devices', page, serializer=PAGES)
+    for page in pages:
+        append_stored_data(wf, 'devices', page)
 
 def get_scenes(wf, api_key):
     """Retrieve all scenes
@@ -34,29 +41,25 @@ def get_scenes(wf, api_key):
     Returns a has of scenes.
 
     """
-    return st_api(wf, api_key, 'scenes', dict(max=200))['items']
+    return st_api(wf, api_key, 'scenes', dict(max=200), cache=True)['items']
+
+def get_rooms(wf, api_key):
+    """Retrieve all rooms in all locations
+
+    Returns a list of rooms.
+
+    """
+    items = []
+    for location in st_api(wf, api_key, 'locations', cache=True)['items']:
+        items.extend(st_api(wf, api_key, 'locations/'+location['locationId']+'/rooms', cache=True)['items'])
+    return items
 
-def get_colors():
-    r = web.get('https://raw.githubusercontent.com/jonathantneal/color-names/master/color-names.json')
+def get_colors(wf):
+    r = web.get('https://raw.githubusercontent.com/jonathantneal/color-names/master/color-names.json', cache=wf.cachefile(HTTP_CACHE))
     flip_colors = r.json()
     colors = {v.lower().replace(' ',''): k for k, v in flip_colors.items()}
     return colors
 
-def get_color(name, colors):
-    name = name.lower().replace(' ','')
-    if re.match('[0-9a-f]{6}', name):
-        return '#'+name.upper()
-    elif name in colors:
-        return colors[name].upper()
-    return ''
-
-def get_device_capabilities(device):
-    capabilities = []
-    if device['components'] and len(device['components']) >  0 and \
-        device['components'][0]['capabilities'] and len(device['components'][0]['capabilities']) > 0:
-            capabilities = list(map( lambda x: x['id'], device['components'][0]['capabilities']))
-    return capabilities
-
 def get_device_commands(device, commands):
     result = []
     capabilities = get_device_capabilities(device)
@@ -66,47 +69,57 @@ def get_device_commands(device, commands):
                 result.append(command) 
     return result
 
-def preprocess_device_command(wf, api_key, args, commands):
-    if 'toggle' == args.device_command:
-        status = st_api(wf, api_key, '/devices/'+args.device_uid+'/status')
-        if status and 'components' in status and 'main' in status['components'] and 'switch' in status['components']['main'] and 'switch' in status['components']['main']['switch'] and 'value' in status['components']['main']['switch']['switch']:
-            state = status['components']['main']['switch']['switch']['value']
-            log.debug("Toggle Switch state is "+state)
-            if 'on' == state:
-                args.device_command = 'off'
-            else:
-                args.device_command = 'on'
-    return args.device_command
+def preprocess_device_command(wf, api_key, args, name, components):
+    """Resolve the command to send to each component - toggle becomes on or off depending on its switch"""
+    if 'toggle' != name:
+        return {component: name for component in components}
+    names = {}
+    status = st_api(wf, api_key, '/devices/'+args.device_uid+'/status')
+    for component in components:
+        detail = status['components'].get(component, {}) if status and 'components' in status else {}
+        state = detail.get('switch', {}).get('switch', {}).get('value')
+        log.debug("Toggle Switch state of "+component+" is "+str(state))
+        names[component] = 'off' if 'on' == state else 'on'
+    return names
 
 def handle_device_commands(wf, api_key, args, commands):
-    if not args.device_uid or args.device_command not in commands.keys():
+    name, components = split_device_command(args.device_command)
+    if not args.device_uid or name not in commands.keys():
         return 
-    args.device_command = preprocess_device_command(wf, api_key, args, commands)
-    command = commands[args.device_command]
-
     device = get_device(wf, args.device_uid)
+    if not device:
+        error('Device not found - run st update')
     device_name = device['label']
-    capabilities = get_device_capabilities(device)
-    if command['capability'] not in capabilities:
+    capabilities = dict(get_component_capabilities(device))
+    if 'all' in components:
+        components = [component for component, ids in capabilities.items() if commands[name]['capability'] in ids]
+    if not components:
         error('Unsupported command for device')
+    names = preprocess_device_command(wf, api_key, args, name, components)
+    for component in components:
+        if commands[names[component]]['capability'] not in capabilities.get(component, []):
+            error('Unsupported command for device')
         
     # eval all lambdas in arguments
-    if 'arguments' in command and command['arguments']:
-        for i, arg in enumerate(command['arguments']):
-            if callable(arg):
-                command['arguments'][i] = arg()
-            elif isinstance(arg, dict):
-                for key, value in arg.items():
-                    if callable(value):
-                        arg[key] = value()                
-
-
-    data = {'commands': [command]}
+    for command in set(names.values()):
+        command = commands[command]
+        if 'arguments' in command and command['arguments']:
+            for i, arg in enumerate(command['arguments']):
+                if callable(arg):
+                    command['arguments'][i] = arg()
+                elif isinstance(arg, dict):
+                    for key, value in arg.items():
+                        if callable(value):
+                            arg[key] = value()                
+
+    # one request for the commands to all components
+    data = {'commands': [dict(commands[names[component]], component=component) for component in components]}
     log.debug("Executing Switch Command: "+device_name+" "+args.device_command)
     result = st_api(wf, api_key,'devices/'+args.device_uid+'/commands', None, 'POST', data)
-    result = (result and result['results']  and len(result['results']) > 0 and result['results'][0]['status'] and 'ACCEPTED' == result['results'][0]['status'])
+    result = (result and result['results'] and len(result['results']) > 0 and all('ACCEPTED' == x.get('status') for x in result['results']))
     if result:
-        qnotify("SmartThings", device_name+" turned "+args.device_command+' '+(args.device_params[0] if args.device_params else ''))
+        record_usage(wf, args.device_uid)
+        qnotify("SmartThings", device_name+(' '+', '.join(components) if ['main'] != components else '')+" turned "+'/'.join(sorted(set(names.values())))+' '+(args.device_params[0] if args.device_params else ''))
     log.debug("Switch Command "+device_name+" "+args.device_command+" "+(args.device_params[0] if args.device_params else '')+' '+("succeeded" if result else "failed"))
     return result
 
@@ -119,15 +132,14 @@ def handle_scene_commands(wf, api_key, args):
     result = st_api(wf, api_key,'scenes/'+args.scene_uid+'/execute', None, 'POST')
     result = (result and result['status'] and 'success' == result['status'])
     if result:
+        record_usage(wf, args.scene_uid)
         qnotify("SmartThings", "Ran "+scene_name)
     log.debug("Scene Command "+scene_name+" "+("succeeded" if result else "failed"))
     return result
 
 def main(wf):
-    # retrieve cached devices and scenes
-    devices = get_stored_data(wf ,'devices')
-    scenes = get_stored_data(wf, 'scenes')
-    colors = get_stored_data(wf, 'colors')
+    # the colors are only loaded if a color command is run - devices and scenes are looked up by uid
+    colors = lazy_stored_data(wf, 'colors', {})
 
     # build argument parser to parse script args and collect their
     # values
@@ -137,6 +149,8 @@ def main(wf):
     # action with the API key
     parser.add_argument('--apikey', dest='apikey', nargs='?', default=None)
     parser.add_argument('--showstatus', dest='showstatus', nargs='?', default=None)
+    # refresh the cached statuses of these device uids - run in the background by filter.py
+    parser.add_argument('--refresh-status', dest='refresh_status', nargs='*', default=[])
     # add an optional (nargs='?') --update argument and save its
     # value to 'apikey' (dest). This will be called from a separate "Run Script"
     # action with the API key
@@ -165,22 +179,18 @@ def main(wf):
             'capability': 'global'
         },
         'on': {
-                'component': 'main',
                 'capability': 'switch',
                 'command': 'on'
         }, 
         'toggle': {
-                'component': 'main',
                 'capability': 'switch',
                 'command': 'on'
         }, 
         'off': {
-                'component': 'main',
                 'capability': 'switch',
                 'command': 'off'
         },
         'dim': {
-                'component': 'main',
                 'capability': 'switchLevel',
                 'command': 'setLevel',
                 'arguments': [
@@ -188,7 +198,6 @@ def main(wf):
                 ]
         },
         'slevel': {
-                'component': 'main',
                 'capability': 'windowShadeLevel',
                 'command': 'setShadeLevel',
                 'arguments': [
@@ -196,37 +205,31 @@ def main(wf):
                 ]
         },
         'open': {
-                'component': 'main',
                 'capability': 'windowShade',
                 'command': 'open'
         },
         'close': {
-                'component': 'main',
                 'capability': 'windowShade',
                 'command': 'close'
         },
         'lock': {
-                'component': 'main',
                 'capability': 'lock',
                 'command': 'lock'
         }, 
         'unlock': {
-                'component': 'main',
                 'capability': 'lock',
                 'command': 'unlock'
         },
         'color': {
-                'component': 'main',
                 'capability': 'colorControl',
                 'command': 'setColor',
                 'arguments': [
                     {
-                        'hex': lambda: get_color(args.device_params[0], colors)
+                        'hex': lambda: get_color(args.device_params[0], colors(), get_stored_data(wf, 'color_index')) or error('Unknown color '+args.device_params[0])
                     }
                 ]
         },
         'mode': {
-            'component': 'main',
             'capability': 'thermostatMode',
             'command': 'setThermostatMode',
             'arguments': [
@@ -234,7 +237,6 @@ def main(wf):
             ]
         },
         'heat': {
-                'component': 'main',
                 'capability': 'thermostatHeatingSetpoint',
                 'command': 'setHeatingSetpoint',
                 'arguments': [
@@ -242,7 +244,6 @@ def main(wf):
                 ]
         },
         'cool': {
-                'component': 'main',
                 'capability': 'thermostatCoolingSetpoint',
                 'command': 'setCoolingSetpoint',
                 'arguments': [
@@ -290,15 +291,23 @@ def main(wf):
     # Update devices if that is passed in
     if args.update:  
         # update devices and scenes
-        devices = get_devices(wf, api_key)
+        sync_devices(wf, api_key)
         scenes = get_scenes(wf, api_key)
-        colors = get_colors()
-        wf.store_data('devices', devices)
+        rooms = get_rooms(wf, api_key)
+        colors = get_colors(wf)
         wf.store_data('scenes', scenes)
+        wf.store_data('rooms', rooms)
         wf.store_data('colors', colors)
+        wf.store_data('color_names', sorted(colors))
+        wf.store_data('color_index', build_color_index(colors))
+        store_index(wf, iter_stored_data(wf, 'devices'), scenes, rooms)
         qnotify('SmartThings', 'Devices and Scenes updated')
         return 0  # 0 means script exited cleanly
 
+    if args.refresh_status:
+        fetch_statuses(wf, api_key, args.refresh_status)
+        return 0
+
    # handle any device or scene commands there may be
     handle_device_commands(wf, api_key, args, commands)
     handle_scene_commands(wf, api_key, args)
@@ -1,5 +1,33 @@
 from workflow import web
+from workflow.workflow import BaseSerializer, manager
+from bisect import bisect_left
+from email.utils import parsedate_to_datetime
+import codecs
 import json
+import pickle
+import random
+import re
+import time
+import urllib.error
+
+# six digit rgb hex color, as typed after the color command
+HEX_COLOR = re.compile('[0-9a-f]{6}')
+
+# st_api retry policy - retries of a GET by default, and the base and cap of the backoff in seconds
+ST_API_RETRIES = 4
+ST_API_BACKOFF = 0.5
+ST_API_MAX_BACKOFF = 30
+# responses worth another try - rate limited or the service is briefly unavailable
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# cache directory of GET responses that are revalidated with their ETag / Last-Modified
+HTTP_CACHE = 'http'
+# bytes read at a time from a streamed listing page
+PAGE_CHUNK = 16384
+# serializer of data stores that are written a page at a time, see PageSerializer
+PAGES = 'pages'
+# data store of the generation of the devices store - a new one for each sync, so an index
+# built from other devices, like the ones before a sync that failed part way, is rebuilt
+DEVICES_GENERATION = 'devices_generation'
 
 
 def qnotify(title, text):
@@ -10,37 +38,178 @@ def error(text):
     exit(0)
 
 def get_device(wf, device_uid):
-    devices = wf.stored_data('devices')
-    return next((x for x in devices if device_uid == x['deviceId']), None)
+    return next((x for x in iter_stored_data(wf, 'devices') if device_uid == x['deviceId']), None)
 
 def get_scene(wf, scene_uid):
     scenes = wf.stored_data('scenes')
     return next((x for x in scenes if scene_uid == x['sceneId']), None)
 
-def st_api(wf, api_key, url, params=None, method='GET', data=None):
+def retry_delay(attempt, error=None):
+    """Seconds to wait before a retry - the Retry-After of a 429 if it has one, else jittered exponential backoff"""
+    retry_after = error.headers.get('Retry-After') if error is not None and error.code == 429 and error.headers else None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0), ST_API_MAX_BACKOFF)
+    # full jitter, so parallel callers hitting the same limit do not retry in lockstep
+    return random.uniform(0, min(ST_API_MAX_BACKOFF, ST_API_BACKOFF * 2 ** attempt))
+
+def should_retry(attempt, retries, error):
+    """Seconds to wait before retrying a request that failed with error, or None to give up"""
+    if attempt == retries:
+        return None
+    if isinstance(error, urllib.error.HTTPError):
+        return retry_delay(attempt, error) if error.code in RETRY_STATUSES else None
+    return retry_delay(attempt)
+
+def st_prepare(wf, api_key, url, params, method, data, retries):
+    """The full url, headers, body and retry count of a SmartThings API call"""
     url = 'https://api.smartthings.com/v1/'+url
     headers = {'Authorization':'Bearer '+api_key,'Accept':"application/json"}
-    r = None
-
-    if('GET' == method):
-        r = web.get(url, params, headers)
-    else:
+    if retries is None:
+        retries = ST_API_RETRIES if 'GET' == method else 0
+    if 'GET' != method:
         headers['Content-type'] = "application/json"
         if data and isinstance(data, dict):
             data = json.dumps(data)
         wf.logger.debug("posting with data "+(data if data else ''))
-        r = web.post(url, params=params, data=data, headers=headers)
 
     wf.logger.debug("st_api: url:"+url+", method: "+method+",  headers: "+str(headers)+", params: "+str(params)+", data: "+str(data))
-    # throw an error if request failed
-    # Workflow will catch this and show it to the user
-    r.raise_for_status()
+    return url, headers, data, retries
+
+def st_request(wf, api_key, url, params=None, method='GET', data=None, retries=None, cache=False, stream=False):
+    """Call the SmartThings API and return the response
 
+    Rate limited, unavailable and unreachable requests are retried with backoff. Only GETs are
+    retried unless retries is given, since a command POST may have been carried out already.
+    With cache a GET is kept on disk and an unchanged response costs a 304.
+    """
+    url, headers, data, retries = st_prepare(wf, api_key, url, params, method, data, retries)
+    for attempt in range(retries + 1):
+        try:
+            if('GET' == method):
+                r = web.get(url, params, headers, stream=stream, cache=wf.cachefile(HTTP_CACHE) if cache else None)
+            else:
+                r = web.post(url, params=params, data=data, headers=headers, stream=stream)
+            # throw an error if request failed
+            # Workflow will catch this and show it to the user
+            r.raise_for_status()
+            return r
+        except urllib.error.URLError as e:
+            delay = should_retry(attempt, retries, e)
+            if delay is None:
+                raise
+        wf.logger.debug("st_api: retrying "+url+" in "+('%.1f' % delay)+"s")
+        time.sleep(delay)
+
+def st_api(wf, api_key, url, params=None, method='GET', data=None, retries=None, cache=False):
+    """Call the SmartThings API and return the parsed json, see st_request"""
     # Parse the JSON returned by pinboard and extract the posts
-    result = r.json()
+    result = st_request(wf, api_key, url, params, method, data, retries, cache).json()
     #log.debug(str(result))
     return result    
 
+async def st_api_async(wf, api_key, url, params=None, method='GET', data=None, retries=None):
+    """Call the SmartThings API on the running event loop and return the parsed json, see st_request
+
+    Many calls can run at once with asyncio.gather, and cancelling the task cancels a call even
+    while it waits to retry.
+    """
+    # imported here so that the script filter, which never calls this, does not load asyncio
+    import asyncio
+    from workflow import aio
+    url, headers, data, retries = st_prepare(wf, api_key, url, params, method, data, retries)
+    for attempt in range(retries + 1):
+        try:
+            if('GET' == method):
+                r = await aio.get(url, params, headers)
+            else:
+                r = await aio.post(url, params=params, data=data, headers=headers)
+            r.raise_for_status()
+            return r.json()
+        except urllib.error.URLError as e:
+            delay = should_retry(attempt, retries, e)
+            if delay is None:
+                raise
+        wf.logger.debug("st_api: retrying "+url+" in "+('%.1f' % delay)+"s")
+        await asyncio.sleep(delay)
+
+def iter_json_items(chunks, key='items', rest=None):
+    """Decode the objects in the key array of a json document as its text chunks arrive
+
+    Only the object being decoded and one chunk are held at a time. The rest of the document, with
+    key set to None, is put in the rest dict.
+    """
+    decoder = json.JSONDecoder()
+    start = re.compile('"'+re.escape(key)+r'"\s*:\s*\[')
+    chunks = iter(chunks)
+    buffer = ''
+    head = None
+    for chunk in chunks:
+        buffer += chunk
+        match = start.search(buffer)
+        if match:
+            head, buffer = buffer[:match.start()], buffer[match.end():]
+            break
+    if head is None:
+        # no array to stream - the whole document is in the buffer
+        document = json.loads(buffer)
+    else:
+        while True:
+            buffer = buffer.lstrip()
+            if buffer.startswith(']'):
+                buffer = buffer[1:]
+                break
+            if buffer.startswith(','):
+                buffer = buffer[1:].lstrip()
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except ValueError:
+                # an object split across chunks - wait for the rest of it
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise
+                buffer += chunk
+                continue
+            yield item
+            buffer = buffer[end:]
+        document = json.loads(head+'"'+key+'":null'+buffer+''.join(chunks))
+    if rest is not None:
+        rest.update(document)
+
+def st_api_pages(wf, api_key, url, params=None, cache=False):
+    """Iterate over a paged SmartThings listing, yielding the items of each page
+
+    Every page is streamed and its items decoded as they arrive, so memory use stays at about one
+    page however long the listing is.
+    """
+    params = dict(params or {}, page=0)
+    while True:
+        r = st_request(wf, api_key, url, params, cache=cache, stream=True)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        rest = {}
+        yield list(iter_json_items((decoder.decode(x) for x in r.iter_content(PAGE_CHUNK)), rest=rest))
+        if 'next' not in (rest.get('_links') or {}):
+            break
+        params['page'] += 1
+
+def split_device_command(command):
+    """Split a device command like on:switch1,switch2 into the command and its components - main if none are given"""
+    name, _, components = command.partition(':')
+    return name, components.split(',') if components else ['main']
+
+def prefix_range(values, prefix):
+    """All values starting with prefix, found by bisecting the sorted values"""
+    start = bisect_left(values, prefix)
+    end = bisect_left(values, prefix + u'\U0010ffff', start)
+    return values[start:end]
+
 def get_stored_data(wf, name):
     data = {}
     try:
@@ -49,3 +218,76 @@ def get_stored_data(wf, name):
         pass
     return data
 
+class PageSerializer(BaseSerializer):
+    """Store a list as a run of pickled pages, so more pages can be appended without rewriting it
+
+    A page cut short by a crash while it was being appended is dropped when loading.
+    """
+
+    is_binary = True
+
+    @classmethod
+    def pages(cls, file_obj):
+        while True:
+            try:
+                yield pickle.load(file_obj)
+            except (EOFError, pickle.UnpicklingError):
+                return
+
+    @classmethod
+    def load(cls, file_obj):
+        return [item for page in cls.pages(file_obj) for item in page]
+
+    @classmethod
+    def dump(cls, obj, file_obj):
+        pickle.dump(list(obj), file_obj, protocol=-1)
+
+manager.register(PAGES, PageSerializer)
+
+def append_stored_data(wf, name, items):
+    """Append a page of items to a data store written with the pages serializer"""
+    with open(wf.datafile(name+'.'+PAGES), 'ab') as file_obj:
+        PageSerializer.dump(items, file_obj)
+
+def iter_stored_data(wf, name):
+    """Iterate over the items of a data store - a page at a time if it was written with the pages serializer"""
+    try:
+        with open(wf.datafile('.'+name+'.alfred-workflow'), encoding='utf-8') as file_obj:
+            serializer = file_obj.read().strip()
+    except OSError:
+        return
+    if PAGES != serializer:
+        yield from get_stored_data(wf, name) or []
+        return
+    try:
+        file_obj = open(wf.datafile(name+'.'+PAGES), 'rb')
+    except OSError:
+        return
+    with file_obj:
+        for page in PageSerializer.pages(file_obj):
+            yield from page
+
+def lazy(load):
+    """Wrap load so it only runs the first time its result is asked for"""
+    loaded = []
+    def get():
+        if not loaded:
+            loaded.append(load())
+        return loaded[0]
+    return get
+
+def lazy_stored_data(wf, name, default=None):
+    """Handle on a stored data set - calling it deserializes the set on first use"""
+    return lazy(lambda: get_stored_data(wf, name) or default)
+
+
+def session_data(wf):
+    """Data cached for the current Alfred session - starts out empty whenever a new session starts"""
+    data = wf.cached_data('session', max_age=0)
+    if not data or data.get('id') != wf.session_id:
+        wf.logger.debug("starting session cache for "+wf.session_id)
+        data = {'id': wf.session_id}
+    return data
+
+def save_session_data(wf, data):
+    wf.cache_data('session', data)
@@ -1,209 +1,206 @@
 # encoding: utf-8
 
 import sys
-import re
 import argparse
 from workflow.workflow import MATCH_ATOM, MATCH_STARTSWITH, MATCH_SUBSTRING, MATCH_ALL, MATCH_INITIALS, MATCH_CAPITALS, MATCH_INITIALS_STARTSWITH, MATCH_INITIALS_CONTAIN
-from workflow import Workflow, ICON_WEB, ICON_NOTE, ICON_BURN, ICON_SWITCH, ICON_HOME, ICON_COLOR, ICON_INFO, ICON_SYNC, web, PasswordNotFound
-from common import st_api, get_stored_data
+from workflow import Workflow, ICON_WEB, ICON_NOTE, ICON_BURN, ICON_SWITCH, ICON_HOME, ICON_COLOR, ICON_INFO, ICON_SYNC, PasswordNotFound
+from common import split_device_command, get_stored_data, lazy, lazy_stored_data, session_data, save_session_data, prefix_range, HEX_COLOR
+from palette import get_color, nearest_color_name, closest_color_names
+from status import device_status, device_statuses, prefetch_status, STATUS_FETCH_LIMIT, STATUS_PENDING
+from index import load_index, search_index, correct_words, load_hot_set, match_hot, get_entity, column_value, CAPABILITIES, CAPABILITY_BITS, DEVICE
 
 log = None
 
-def get_device_icon(device):
-    capabilities = get_device_capabilities(device)
-    if 'thermostatMode' in capabilities:
-        icon = 'thermostat'
-    elif 'lock' in capabilities:
-        icon = 'lock'
-    elif 'colorControl' in capabilities:
-        icon = 'color-light'
-    elif 'switchLevel' in capabilities:
-        icon = 'light'
-    elif 'windowShade' in capabilities:
-        icon = 'shade'
-    elif 'contactSensor' in capabilities:
-        icon = 'contact'
-    else:
-        icon = 'switch'
-    return 'icons/'+icon+'.png'
-
-def get_color(name, colors):
-    name = name.lower().replace(' ','')
-    if re.match('[0-9a-f]{6}', name):
-        return '#'+name.upper()
-    elif name in colors:
-        return colors[name].upper()
-    return ''
-
-def get_device_capabilities(device):
-    capabilities = []
-    if device['components'] and len(device['components']) >  0 and \
-        device['components'][0]['capabilities'] and len(device['components'][0]['capabilities']) > 0:
-            capabilities = list(map( lambda x: x['id'], device['components'][0]['capabilities']))
-    return capabilities
-
-def search_key_for_device(device, commands):
-    """Generate a string search key for a switch"""
-    elements = []
-    supported_capabilities = set(map(lambda x: x[1]['capability'], commands.items()))
-    #log.debug("supported capabilities are : "+str(supported_capabilities))
-    capabilities = get_device_capabilities(device)
-    if len(list(set(capabilities) & supported_capabilities)) > 0:
-        elements.append(device['label'])  # label of device
-    return u' '.join(elements)
-
-def search_key_for_scene(scene):
-    """Generate a string search key for a scene"""
-    elements = []
-    elements.append(scene['sceneName'])  # name of scene
-    return u' '.join(elements)
-
-def add_config_commands(args, config_commands):
-    word = args.query.lower().split(' ')[0] if args.query else ''
-    config_command_list = wf.filter(word, config_commands.keys(), min_score=80, match_on=MATCH_SUBSTRING | MATCH_STARTSWITH | MATCH_ATOM)
-    if config_command_list:
-        for cmd in config_command_list:
-            wf.add_item(config_commands[cmd]['title'],
-                        config_commands[cmd]['subtitle'],
-                        arg=config_commands[cmd]['args'],
-                        autocomplete=config_commands[cmd]['autocomplete'],
-                        icon=config_commands[cmd]['icon'],
-                        valid=config_commands[cmd]['valid'])
-    return config_command_list
+# seconds Alfred caches the full item set of `filter.py --all`, reloading it in the background
+ALL_ITEMS_CACHE = 3600
+
+# seconds a keystroke may take - statuses that can not be fetched in time are shown as pending
+LATENCY_BUDGET = 0.15
+
+def add_config_command(config_commands, cmd):
+    wf.add_item(config_commands[cmd]['title'],
+                config_commands[cmd]['subtitle'],
+                arg=config_commands[cmd]['args'],
+                autocomplete=config_commands[cmd]['autocomplete'],
+                icon=config_commands[cmd]['icon'],
+                valid=config_commands[cmd]['valid'])
+
+def add_scene(scene, match=None, uid=None):
+    wf.add_item(title=scene['label'],
+            subtitle=scene['subtitle'],
+            arg=scene['arg'],
+            autocomplete=scene['label'],
+            valid=True,
+            uid=uid,
+            icon=scene['icon'],
+            match=match)
+
+def device_rooms(index):
+    """Room names by device position"""
+    return {pos: partition['name'] for partition in index['rooms'].values() for pos in partition['positions']}
+
+def add_all_items(wf, index, commands, config_commands):
+    """Add an item for every device command that takes no params, every scene and config command
+
+    For a Script Filter with "Alfred filters results" on, so Alfred does the matching - against
+    the room name, label and command of each item. Commands that take params and the status
+    command need the query, so they are left to the st Script Filter.
+
+    """
+    rooms = device_rooms(index)
+    for pos in range(len(index['types'])):
+        if not index['eligible'][pos]:
+            continue
+        entity = get_entity(index, pos)
+        if 'scene' == entity['type']:
+            add_scene(entity, match=entity['label'], uid=entity['id'])
+        elif 'config' == entity['type']:
+            if config_commands[entity['id']]['valid']:
+                add_config_command(config_commands, entity['id'])
+        else:
+            # labels often hold their room name already
+            room = rooms.get(pos)
+            if room and room.lower() in entity['label'].lower():
+                room = None
+            for command in get_device_commands(wf, entity, commands):
+                if 'status' == command or 'arguments' in commands[split_device_command(command)[0]]:
+                    continue
+                wf.add_item(title=entity['label'],
+                        subtitle=entity['subtitle']+command,
+                        arg=entity['arg']+command+' --device-params ',
+                        autocomplete=entity['label']+' '+command,
+                        valid=True,
+                        uid=entity['id']+':'+command,
+                        icon=entity['icon'],
+                        match=' '.join(filter(None, [room, entity['label'], command.replace(':', ' ')])))
 
 def get_device_commands(wf, device, commands):
+    """Commands for the capabilities of the device
+
+    Commands for components other than main are suffixed with :component, and commands for a
+    capability of several components also come suffixed with :all to run on all of them at once.
+
+    """
     result = []
-    capabilities = get_device_capabilities(device)
-    if not should_show_status(wf):
-        capabilities.append('global')
-    for capability in capabilities:
-        for command, map in commands.items():
-            if capability == map['capability']:
-                result.append(command) 
+    components = device['components'] or [('main', device['mask'])]
+    for i, (component, mask) in enumerate(components):
+        suffix = ':'+component if i else ''
+        if not i and not should_show_status(wf):
+            mask |= CAPABILITY_BITS['global']
+        for capability in CAPABILITIES:
+            if not mask & CAPABILITY_BITS[capability]:
+                continue
+            for command, map in commands.items():
+                if capability == map['capability']:
+                    result.append(command+suffix)
+    for capability in CAPABILITIES if len(components) > 1 else []:
+        if 1 < len([mask for _, mask in components if mask & CAPABILITY_BITS[capability]]):
+            result += [command+':all' for command, map in commands.items() if capability == map['capability']]
     return result
 
-def get_filtered_devices(wf, query, devices, commands):
-    result = wf.filter(query, devices, key=lambda x: search_key_for_device(x, commands), min_score=80, match_on=MATCH_SUBSTRING | MATCH_STARTSWITH | MATCH_ATOM)
-    # check to see if the first one is an exact match - if yes, remove all the other results
-    if result and query and 'label' in result[0] and result[0]['label'] and result[0]['label'].lower() == query.lower():
-        result = result[0:1]
+def exact_match(index, result, query):
+    # check to see if the first device is an exact match - if yes, remove all the other devices
+    devices = only_devices(index, result)
+    if devices and query and column_value(index, 'labels', devices[0]).lower() == query.lower():
+        result = [x for x in result if DEVICE != index['types'][x] or x == devices[0]]
     return result
 
-def extract_commands(wf, args, devices, commands):
+def only_devices(index, result):
+    return [x for x in result if DEVICE == index['types'][x]]
+
+def extract_commands(wf, args, index, keep=lambda words: ()):
+    """Split the query into device, command and params with a single sweep over the index
+
+    Returns the ranked devices, scenes and config commands for the device part of the query -
+    a single device among them if a command was split off - only these are materialized from the
+    index. Used devices win ties and an exact label match among the most used devices skips the
+    search over the devices.
+    If nothing matches, label words with typos are corrected - leaving the words keep returns for
+    the query words alone - and the query is tried again.
+
+    """
     words = args.query.split() if args.query else []
     args.device_command = ''
     args.device_params = []
-    if devices:
-        full_devices = get_filtered_devices(wf, args.query,  devices, commands)
-        minusone_devices = get_filtered_devices(wf, ' '.join(words[0:-1]),  devices, commands)
-        minustwo_devices = get_filtered_devices(wf, ' '.join(words[0:-2]),  devices, commands)
-
-        if 1 == len(minusone_devices) and (0 == len(full_devices) or (1 == len(full_devices) and full_devices[0]['deviceId'] == minusone_devices[0]['deviceId'])):
-            extra_words = args.query.replace(minusone_devices[0]['label'],'').split()
-            if extra_words:
-                log.debug("extract_commands: setting command to "+extra_words[0])
-                args.device_command = extra_words[0]
-                args.query = minusone_devices[0]['label']
-        if 1 == len(minustwo_devices) and 0 == len(full_devices) and 0 == len(minusone_devices):
-            extra_words = args.query.replace(minustwo_devices[0]['label'],'').split()
-            if extra_words:
-                args.device_command = extra_words[0]
-                args.query = minustwo_devices[0]['label']
-                args.device_params = extra_words[1:]
-        log.debug("extract_commands: "+str(args))
-    return args
-
-def device_status(wf, api_key, device):
-    caps = {
-        'switch': {
-            'tag': 'switch',
-            'icon': u'🎚'
-        },
-        'switchLevel': {
-            'tag': 'level',
-            'icon': u'💡'
-        },
-        'lock': {
-            'tag': 'lock',
-            'icon': u'🔒'
-        },
-        'battery': {
-            'tag': 'battery',
-            'icon': u'🔋'
-        },
-        'colorControl': {
-            'tag': 'color',
-            'icon': u'🎨'
-        },
-        'windowShade': {
-            'tag': 'windowShade',
-            'icon': u'🪟'
-        },
-        'windowShadeLevel': {
-            'tag': 'shadeLevel',
-            'icon': u'🌒'
-        },
-        'contactSensor': {
-            'tag': 'contact',
-            'icon': u'🔓'
-        },
-        'thermostat': [
-        {
-            'tag': 'heatingSetpoint',
-            'icon': u'🔥'
-        },
-        {
-            'tag': 'coolingSetpoint',
-            'icon': u'❄️'
-        },
-        {
-            'tag': 'thermostatOperatingState',
-            'icon': u'🏃🏻‍♀️'
-        },
-        {
-            'tag': 'temperature',
-            'icon': u'🌡'
-        },
-        {
-            'tag': 'thermostatFanMode',
-            'icon': u'💨'
-        },
-        {
-            'tag': 'thermostatMode',
-            'icon': u'😰'
-        }
-        ]
-    }
-    subtitle = ''
-    status = st_api(wf, api_key, '/devices/'+device['deviceId']+'/status')
-    if status and 'components' in status and 'main' in status['components']:
-        detail = status['components']['main']
-        for cap in caps:
-            if not cap in detail: continue
-            metas = caps[cap]
-            if not isinstance(metas, list):
-                metas = [metas]
-            for meta in metas:
-                tag = meta['tag']
-                if not tag in detail[cap]: continue
-                log.debug(device['label']+' '+cap+' '+tag)
-                subtitle += u'  '+meta['icon']+' '+str(detail[cap][tag]['value'])+(detail[cap][tag]['unit'] if 'unit' in detail[cap][tag] else '')
-    return subtitle
+    # check the most used devices first - an exact label match there needs no full index search
+    hot = load_hot_set(wf, index)
+    device, result = match_hot(wf, index, hot, words)
+    if device is not None:
+        log.debug("extract_commands: hot device "+column_value(index, 'labels', device))
+        return [get_entity(index, pos) for pos in result]
+    hot = set(hot)
+    splits = search_index(wf, ' '.join(words), index, drops=2, hot=hot)
+    if not any(result for drop, result in enumerate(splits) if len(words) - drop > 0):
+        corrected = correct_words(index, words, keep(words))
+        if corrected != words:
+            log.debug("extract_commands: no matches, trying "+' '.join(corrected))
+            words = corrected
+            args.query = ' '.join(words)
+            splits = search_index(wf, args.query, index, drops=2, hot=hot)
+    splits = [exact_match(index, result, ' '.join(words[0:len(words)-drop])) for drop, result in enumerate(splits)]
+    full_devices, minusone_devices, minustwo_devices = [only_devices(index, result) for result in splits]
+
+    result = splits[0]
+    if 1 == len(minusone_devices) and (0 == len(full_devices) or (1 == len(full_devices) and full_devices[0] == minusone_devices[0])):
+        extra_words = remaining_words(args.query, column_value(index, 'labels', minusone_devices[0]), words[len(words)-1:])
+        if extra_words:
+            log.debug("extract_commands: setting command to "+extra_words[0])
+            args.device_command = extra_words[0]
+            args.query = column_value(index, 'labels', minusone_devices[0])
+            result = splits[1]
+    if 1 == len(minustwo_devices) and 0 == len(full_devices) and 0 == len(minusone_devices):
+        extra_words = remaining_words(args.query, column_value(index, 'labels', minustwo_devices[0]), words[len(words)-2:])
+        if extra_words:
+            args.device_command = extra_words[0]
+            args.query = column_value(index, 'labels', minustwo_devices[0])
+            args.device_params = extra_words[1:]
+            result = splits[2]
+    log.debug("extract_commands: "+str(args))
+    return [get_entity(index, pos) for pos in result]
+
+def protected_words(words, commands, command_params):
+    """Lowercased command names in words, and every word after a command that takes params"""
+    protected = set()
+    for i, word in enumerate(words):
+        lower = word.lower()
+        if lower in commands:
+            protected.add(lower)
+            if lower in command_params:
+                protected.update(x.lower() for x in words[i+1:])
+                break
+    return protected
+
+def leading_device(devices, query):
+    """The first device if it clearly leads the ranking - the only one whose label starts with the query"""
+    leaders = [x for x in devices if x['label'].lower().startswith(query.lower())]
+    if 1 == len(leaders) and leaders[0] is devices[0]:
+        return devices[0]
+    return None
+
+def remaining_words(query, label, tail):
+    """Words of the query following the device label - anything before it, like a room name, is dropped"""
+    start = query.lower().find(label.lower())
+    if start < 0:
+        return tail
+    return query[start+len(label):].split()
 
 def should_show_status(wf):
     return ('on' == wf.settings['showstatus']) if 'showstatus' in wf.settings else False
 
 def main(wf):
-    # retrieve cached devices and scenes
-    devices = get_stored_data(wf, 'devices')
-    scenes = get_stored_data(wf, 'scenes')
-    colors = get_stored_data(wf, 'colors')
+    # retrieve the search index - the color stores are only loaded if the color command is used
+    index = load_index(wf)
+    colors = lazy_stored_data(wf, 'colors', {})
+    color_names = lazy(lambda: get_stored_data(wf, 'color_names') or sorted(colors()))
+    color_index = lazy_stored_data(wf, 'color_index')
 
     # build argument parser to parse script args and collect their
     # values
     parser = argparse.ArgumentParser()
     # add an optional query and save it to 'query'
     parser.add_argument('query', nargs='?', default=None)
+    # list every device command and scene for Alfred to filter, instead of filtering a query
+    parser.add_argument('--all', dest='all', action='store_true', default=False)
     # parse the script's arguments
     args = parser.parse_args(wf.args)
 
@@ -217,22 +214,18 @@ def main(wf):
             'capability': 'global'
         },
         'on': {
-                'component': 'main',
                 'capability': 'switch',
                 'command': 'on'
         }, 
         'off': {
-                'component': 'main',
                 'capability': 'switch',
                 'command': 'off'
         },
         'toggle': {
-                'component': 'main',
                 'capability': 'switch',
                 'command': 'off'
         },
         'dim': {
-                'component': 'main',
                 'capability': 'switchLevel',
                 'command': 'setLevel',
                 'arguments': [
@@ -240,7 +233,6 @@ def main(wf):
                 ]
         },
         'slevel': {
-                'component': 'main',
                 'capability': 'windowShadeLevel',
                 'command': 'setShadeLevel',
                 'arguments': [
@@ -248,42 +240,35 @@ def main(wf):
                 ]
         },
         'open': {
-                'component': 'main',
                 'capability': 'windowShade',
                 'command': 'open'
         },
         'close': {
-                'component': 'main',
                 'capability': 'windowShade',
                 'command': 'close'
         },
         'lock': {
-                'component': 'main',
                 'capability': 'lock',
                 'command': 'lock'
         }, 
         'unlock': {
-                'component': 'main',
                 'capability': 'lock',
                 'command': 'unlock'
         },
         'view': {
-                'component': 'main',
                 'capability': 'contactSensor',
                 'command': 'view'
         },
         'color': {
-                'component': 'main',
                 'capability': 'colorControl',
                 'command': 'setColor',
                 'arguments': [
                     {
-                        'hex': lambda: get_color(args.device_params[0], colors)
+                        'hex': lambda: get_color(args.device_params[0], colors(), color_index())
                     }
                 ]
         },
         'mode': {
-            'component': 'main',
             'capability': 'thermostatMode',
             'command': 'setThermostatMode',
             'arguments': [
@@ -291,7 +276,6 @@ def main(wf):
             ]
         },
         'heat': {
-                'component': 'main',
                 'capability': 'thermostatHeatingSetpoint',
                 'command': 'setHeatingSetpoint',
                 'arguments': [
@@ -299,7 +283,6 @@ def main(wf):
                 ]
         },
         'cool': {
-                'component': 'main',
                 'capability': 'thermostatCoolingSetpoint',
                 'command': 'setCoolingSetpoint',
                 'arguments': [
@@ -310,11 +293,14 @@ def main(wf):
 
     command_params = {
         'color': {
-            'values': colors.keys() if colors else [],
-            'regex': '[0-9a-f]{6}'
+            'values': color_names,
+            'regex': HEX_COLOR,
+            'describe': lambda x: nearest_color_name(color_index(), x),
+            # skipped once the latency budget is spent - the value is then offered as typed
+            'closest': lambda x: closest_color_names(color_index(), x) if wf.budget_remaining() is None or wf.budget_remaining() > 0 else []
         },
         'mode': {
-            'values': ['auto','heat','cool','off']
+            'values': lambda: ['auto','cool','heat','off']
         }
     }
 
@@ -361,8 +347,23 @@ def main(wf):
         }
     }
 
-    # add config commands to filter
-    add_config_commands(args, config_commands)
+    # match devices, scenes and config commands in one pass over the index. Since this may be
+    # a device query, fix args if there is a device command in there - reusing the split if
+    # this query was already seen this session
+    session = session_data(wf)
+    splits = session.setdefault('splits', {})
+    split_key = (index['updated'], args.query)
+    if split_key in splits:
+        positions, args.device_command, args.device_params, args.query = splits[split_key]
+        results = [get_entity(index, pos) for pos in positions]
+    else:
+        keep = lambda words: protected_words(words, commands, command_params)
+        results = extract_commands(wf, args, index, keep)
+        splits[split_key] = ([entity['pos'] for entity in results], args.device_command, args.device_params, args.query)
+    save_session_data(wf, session)
+
+    # update query post extraction
+    query = args.query
 
     ####################################################################
     # Check that we have an API key saved
@@ -371,6 +372,9 @@ def main(wf):
     try:
         api_key = wf.get_password('smartthings_api_key')
     except PasswordNotFound:  # API key has not yet been set
+        for entity in results:
+            if 'config' == entity['type']:
+                add_config_command(config_commands, entity['id'])
         wf.add_item('No API key set...',
                     'Please use st apikey to set your SmartThings API key.',
                     valid=False,
@@ -378,13 +382,6 @@ def main(wf):
         wf.send_feedback()
         return 0
 
-    # since this i now sure to be a device/scene query, fix args if there is a device/scene command in there
-    args = extract_commands(wf, args, devices, commands)
- 
-    # update query post extraction
-    query = args.query
-
-
     ####################################################################
     # View/filter devices or scenes
     ####################################################################
@@ -398,100 +395,126 @@ def main(wf):
             icon=ICON_INFO)
 
 
-    if not devices or len(devices) < 1:
+    if index['device_count'] < 1:
+        for entity in results:
+            if 'config' == entity['type']:
+                add_config_command(config_commands, entity['id'])
         wf.add_item('No Devices...',
                     'Please use st update - to update your SmartThings devices.',
                     valid=False,
                     icon=ICON_NOTE)
         wf.send_feedback()
         return 0
-    if not scenes:
-        scenes = dict()
+
+    if args.all:
+        add_all_items(wf, index, commands, config_commands)
+        wf.set_feedback_cache(ALL_ITEMS_CACHE, loosereload=True)
+        wf.send_feedback()
+        return 0
 
     # If script was passed a query, use it to filter posts
     if query:
-        devices = get_filtered_devices(wf, query, devices, commands)
-        scenes = wf.filter(query, scenes, key=search_key_for_scene, min_score=80, match_on=MATCH_SUBSTRING | MATCH_STARTSWITH | MATCH_ATOM)
-
-        if devices:
-            if 1 == len(devices) and should_show_status(wf):
-                device = devices[0]
-                wf.add_item(title=device['label'],
-                        subtitle=device_status(wf, api_key, device),
-                        arg=' --device-uid '+device['deviceId']+' --device-command '+args.device_command,
-                        autocomplete=device['label']+' '+args.device_command,
-                        valid=False,
-                        icon=get_device_icon(device))
-            if 1 == len(devices) and (not args.device_command or args.device_command not in commands):
-                # Single device only, no command or not complete command yet so populate with all the commands
-                device = devices[0]
-                device_commands = get_device_commands(wf, device, commands)
-                device_commands = list(filter(lambda x: x.startswith(args.device_command), device_commands))
-                log.debug('args.device_command is '+args.device_command)
-                for command in device_commands:
-                    wf.add_item(title=device['label'],
-                            subtitle='Turn '+device['label']+' '+command+' '+(' '.join(args.device_params) if args.device_params else ''),
-                            arg=' --device-uid '+device['deviceId']+' --device-command '+command+' --device-params '+(' '.join(args.device_params)),
-                            autocomplete=device['label']+' '+command,
-                            valid=bool('status' != command and ('arguments' not in commands[command] or args.device_params)),
-                            icon=get_device_icon(device))
-            elif 1 == len(devices) and (args.device_command and args.device_command in commands and args.device_command in command_params):
-                # single device and has command already - populate with params?
-                device = devices[0]
-                param_list = command_params[args.device_command]['values']
-                param_start = args.device_params[0] if args.device_params else ''
-                param_list = list(filter(lambda x: x.startswith(param_start), param_list))
-                param_list.sort()
-                check_regex = False
-                if not param_list and command_params[args.device_command]['regex']:
-                    param_list.append(args.device_params[0].lower())
-                    check_regex = True
-                for param in param_list:
-                    wf.add_item(title=device['label'],
-                            subtitle='Turn '+device['label']+' '+args.device_command+' '+param,
-                            arg=' --device-uid '+device['deviceId']+' --device-command '+args.device_command+' --device-params '+param,
-                            autocomplete=device['label']+' '+args.device_command,
-                            valid=bool(not check_regex or re.match(command_params[args.device_command]['regex'], param)),
-                            icon=get_device_icon(device))
-            elif 1 == len(devices) and ('status' == args.device_command):
-                device = devices[0]
-                wf.add_item(title=device['label'],
-                        subtitle=device_status(wf, api_key, device),
-                        arg=' --device-uid '+device['deviceId']+' --device-command '+args.device_command,
-                        autocomplete=device['label']+' '+args.device_command,
-                        valid=False,
-                        icon=get_device_icon(device))
-            else:
-                # Loop through the returned devices and add an item for each to
-                # the list of results for Alfred
-                for device in devices:
-                    wf.add_item(title=device['label'],
-                            subtitle='Turn '+device['label']+' '+args.device_command+' '+(' '.join(args.device_params) if args.device_params else ''),
-                            arg=' --device-uid '+device['deviceId']+' --device-command '+args.device_command+' --device-params '+(' '.join(args.device_params)),
-                            autocomplete=device['label'],
-                            valid=bool(args.device_command in commands),
-                            icon=get_device_icon(device))
-
-
-        # Loop through the returned scenes and add an item for each to
+        devices = [entity for entity in results if 'device' == entity['type']]
+        statuses = None
+        if 1 < len(devices) and should_show_status(wf):
+            statuses = device_statuses(wf, api_key, devices)
+        elif 1 < len(devices) and leading_device(devices, query):
+            # statuses are not shown, but the status command is likely to be asked for next
+            prefetch_status(wf, devices[0]['id'])
+
+        # Loop through the ranked devices, scenes and config commands and add items for each to
         # the list of results for Alfred
-        for scene in scenes:
-            wf.add_item(title=scene['sceneName'],
-                    subtitle='Run '+scene['sceneName'],
-                    arg=' --scene-uid '+scene['sceneId'],
-                    autocomplete=scene['sceneName'],
-                    valid=True,
-                    icon='icons/scene.png')
+        for entity in results:
+            if 'config' == entity['type']:
+                add_config_command(config_commands, entity['id'])
+            elif 'scene' == entity['type']:
+                add_scene(entity)
+            elif 1 == len(devices):
+                add_single_device(wf, api_key, args, entity, commands, command_params)
+            else:
+                device = entity
+                status = ''
+                if statuses is not None and device in devices[:STATUS_FETCH_LIMIT]:
+                    status = statuses.get(device['id'], STATUS_PENDING)
+                wf.add_item(title=device['label'],
+                        subtitle=device['subtitle']+args.device_command+' '+(' '.join(args.device_params) if args.device_params else '')+status,
+                        arg=device['arg']+args.device_command+' --device-params '+(' '.join(args.device_params)),
+                        autocomplete=device['label'],
+                        valid=bool(split_device_command(args.device_command)[0] in commands),
+                        icon=device['icon'])
 
         # Send the results to Alfred as XML
         wf.send_feedback()
     return 0
 
+def add_single_device(wf, api_key, args, device, commands, command_params):
+    """Add the status, command or param items for the only matching device"""
+    command_name = split_device_command(args.device_command)[0]
+    device_commands = get_device_commands(wf, device, commands)
+    if should_show_status(wf):
+        wf.add_item(title=device['label'],
+                subtitle=device_status(wf, api_key, device),
+                arg=device['arg']+args.device_command,
+                autocomplete=device['label']+' '+args.device_command,
+                valid=False,
+                icon=device['icon'])
+    if not args.device_command or command_name not in commands or (':' in args.device_command and args.device_command not in device_commands):
+        # Single device only, no command or not complete command or component yet so populate with all the commands
+        device_commands = list(filter(lambda x: x.startswith(args.device_command), device_commands))
+        log.debug('args.device_command is '+args.device_command)
+        for command in device_commands:
+            wf.add_item(title=device['label'],
+                    subtitle=device['subtitle']+command+' '+(' '.join(args.device_params) if args.device_params else ''),
+                    arg=device['arg']+command+' --device-params '+(' '.join(args.device_params)),
+                    autocomplete=device['label']+' '+command,
+                    valid=bool('status' != command and ('arguments' not in commands[split_device_command(command)[0]] or args.device_params)),
+                    icon=device['icon'])
+    elif command_name in command_params:
+        # single device and has command already - populate with params?
+        # values are kept sorted so completions are a bisected range
+        params = command_params[command_name]
+        param_start = args.device_params[0] if args.device_params else ''
+        param_list = prefix_range(params['values'](), param_start)
+        check_regex = False
+        described = {}
+        if not param_list and params.get('regex'):
+            param = args.device_params[0].lower()
+            if params['regex'].match(param) and 'describe' in params:
+                # show the closest named value for a raw value
+                described[param] = params['describe'](param)
+            elif not params['regex'].match(param) and 'closest' in params:
+                # offer the closest known values for a misspelt one
+                param_list = params['closest'](param)
+            if not param_list:
+                param_list = [param]
+                check_regex = True
+        for param in param_list:
+            wf.add_item(title=device['label'],
+                    subtitle=device['subtitle']+args.device_command+' '+param+(' ~ '+described[param] if described.get(param) else ''),
+                    arg=device['arg']+args.device_command+' --device-params '+param,
+                    autocomplete=device['label']+' '+args.device_command,
+                    valid=bool(not check_regex or params['regex'].match(param)),
+                    icon=device['icon'])
+    elif 'status' == args.device_command:
+        wf.add_item(title=device['label'],
+                subtitle=device_status(wf, api_key, device),
+                arg=device['arg']+args.device_command,
+                autocomplete=device['label']+' '+args.device_command,
+                valid=False,
+                icon=device['icon'])
+    else:
+        wf.add_item(title=device['label'],
+                subtitle=device['subtitle']+args.device_command+' '+(' '.join(args.device_params) if args.device_params else ''),
+                arg=device['arg']+args.device_command+' --device-params '+(' '.join(args.device_params)),
+                autocomplete=device['label'],
+                valid=bool(command_name in commands),
+                icon=device['icon'])
+
 
 if __name__ == u"__main__":
     wf = Workflow(update_settings={
         'github_slug': 'schwark/alfred-smartthings-py'
-    })
+    }, latency_budget=LATENCY_BUDGET)
     log = wf.logger
     sys.exit(wf.run(main))
     
\ No newline at end of file
@@ -0,0 +1,476 @@
+# encoding: utf-8
+
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from workflow import Workflow
+from workflow.workflow import split_on_delimiters, isascii
+from common import DEVICES_GENERATION, get_stored_data, iter_stored_data
+
+# bump whenever the layout of a stored index changes so stale indexes get rebuilt
+INDEX_VERSION = 10
+
+# capabilities that filter.py offers commands for, in the order their commands are listed -
+# these always get the lowest bits so masks can be tested against CAPABILITY_BITS directly.
+# 'global' is the pseudo capability of the status command
+CAPABILITIES = [
+    'switch',
+    'switchLevel',
+    'windowShade',
+    'windowShadeLevel',
+    'lock',
+    'contactSensor',
+    'colorControl',
+    'thermostatMode',
+    'thermostatHeatingSetpoint',
+    'thermostatCoolingSetpoint',
+    'global',
+]
+CAPABILITY_BITS = {name: 1 << i for i, name in enumerate(CAPABILITIES)}
+
+# devices with none of these are not searchable
+SUPPORTED_MASK = sum(CAPABILITY_BITS.values()) & ~CAPABILITY_BITS['global']
+
+# masks are stored in an array('Q'), so capabilities seen after the first 64 get no bit
+MASK_BITS = 64
+
+# usage counts halve every week and the hottest devices and scenes are checked before the full index
+USAGE_HALF_LIFE = 7 * 24 * 60 * 60
+HOT_SET_SIZE = 20
+
+# config commands offered by filter.py - these are only matched against the first word of a query
+CONFIG_COMMANDS = ['update', 'apikey', 'showstatus', 'reinit', 'workflow:update']
+
+# first capability a device has decides its icon
+DEVICE_ICONS = [
+    (CAPABILITY_BITS['thermostatMode'], 'thermostat'),
+    (CAPABILITY_BITS['lock'], 'lock'),
+    (CAPABILITY_BITS['colorControl'], 'color-light'),
+    (CAPABILITY_BITS['switchLevel'], 'light'),
+    (CAPABILITY_BITS['windowShade'], 'shade'),
+    (CAPABILITY_BITS['contactSensor'], 'contact'),
+]
+
+# item icons, stored by their position in this list - config commands have their own
+ITEM_ICONS = ['', 'icons/switch.png', 'icons/scene.png'] + ['icons/'+icon+'.png' for _, icon in DEVICE_ICONS]
+
+# entity types, stored by their position in this list. Devices always come first in the index
+ENTITY_TYPES = ['device', 'scene', 'config']
+DEVICE, SCENE, CONFIG = range(len(ENTITY_TYPES))
+
+# ends every value in a column blob - it can not appear in a query word, so a match never spans values
+SEPARATOR = u'\x00'
+
+def get_device_capabilities(device, component=None):
+    """Capability ids of a component of the device - the first component, main, by default"""
+    components = get_component_capabilities(device)
+    if component is None:
+        return components[0][1] if components else []
+    return dict(components).get(component, [])
+
+def get_component_capabilities(device):
+    """(component id, capability ids) for every component of the device, main first"""
+    return [(component['id'], list(map(lambda x: x['id'], component['capabilities'] or []))) for component in device['components'] or []]
+
+def capability_mask(capabilities, bits=CAPABILITY_BITS):
+    """OR together the bits of the given capability ids, ignoring ids that have no bit"""
+    mask = 0
+    for capability in capabilities:
+        mask |= bits.get(capability, 0)
+    return mask
+
+def intern_capabilities(capabilities, bits):
+    """Return the mask for capabilities, assigning new bits in bits for unseen ids while any are left"""
+    for capability in capabilities:
+        if capability not in bits and len(bits) < MASK_BITS:
+            bits[capability] = 1 << len(bits)
+    return capability_mask(capabilities, bits)
+
+def pack_column(values):
+    """Join string values into one blob, each ended by SEPARATOR, with an array of their start offsets"""
+    offsets = array('I')
+    start = 0
+    for value in values:
+        offsets.append(start)
+        start += len(value) + 1
+    offsets.append(start)
+    return SEPARATOR.join(values) + SEPARATOR, offsets
+
+def column_value(index, name, pos):
+    """The value at pos of a packed column"""
+    blob, offsets = index[name]
+    return blob[offsets[pos]:offsets[pos + 1] - 1]
+
+def find_positions(index, name, word):
+    """Positions of the values of a packed column that contain word, found with str.find over the blob"""
+    blob, offsets = index[name]
+    positions = []
+    start = blob.find(word)
+    while start >= 0:
+        pos = bisect_right(offsets, start) - 1
+        positions.append(pos)
+        # one hit per value is enough, so carry on from the next one
+        start = blob.find(word, offsets[pos + 1])
+    return positions
+
+def position_of(index, name, value):
+    """Position of the first value of a packed column equal to value, or None"""
+    blob, offsets = index[name]
+    start = blob.find(value + SEPARATOR)
+    while start >= 0:
+        pos = bisect_right(offsets, start) - 1
+        if offsets[pos] == start:
+            return pos
+        start = blob.find(value + SEPARATOR, start + 1)
+    return None
+
+def get_device_icon(mask):
+    """Position in ITEM_ICONS of the icon for a device with the capability mask"""
+    icon = next((icon for bit, icon in DEVICE_ICONS if mask & bit), 'switch')
+    return ITEM_ICONS.index('icons/'+icon+'.png')
+
+def item_templates(entity_type, uid, label, mask):
+    """The icon, arg prefix and subtitle prefix of the Alfred items of an entity.
+
+    Items only need the command and params filled in: device args go on with the command,
+    and device subtitles with the command and params.
+
+    """
+    if DEVICE == entity_type:
+        return get_device_icon(mask), ' --device-uid '+uid+' --device-command ', 'Turn '+label+' '
+    if SCENE == entity_type:
+        return ITEM_ICONS.index('icons/scene.png'), ' --scene-uid '+uid, 'Run '+label
+    return 0, '', ''
+
+def get_entity(index, pos):
+    """Materialize the entity at pos as a dict - only done for entities that end up in the results"""
+    return {
+        'pos': pos,
+        'type': ENTITY_TYPES[index['types'][pos]],
+        'id': column_value(index, 'ids', pos),
+        'label': column_value(index, 'labels', pos),
+        'mask': index['masks'][pos],
+        'components': index['components'].get(pos, []),
+        'eligible': bool(index['eligible'][pos]),
+        'icon': ITEM_ICONS[index['icons'][pos]],
+        'arg': column_value(index, 'args', pos),
+        'subtitle': column_value(index, 'subtitles', pos)
+    }
+
+def build_index(devices, scenes, rooms):
+    """Build the persistent search index of devices, scenes and config commands - run at st update time
+
+    The index is columnar so filter.py never unpickles the raw device records: labels, their
+    lower-cased and diacritic-folded search keys and ids are each packed into one string with
+    an array of offsets, and types, capability masks and searchability are arrays indexed by
+    position. A device mask covers all its components, and devices with more than main also
+    get the mask of each component. Devices are also partitioned by SmartThings room, so queries starting with a room
+    name only score the devices in that room. The icons and the arg and subtitle prefixes of
+    the Alfred items are built here too, so rendering only fills in commands and params.
+
+    """
+    bits = dict(CAPABILITY_BITS)
+    rows = []
+    components = {}
+    device_rooms = []
+    for device in devices or []:
+        masks = [(component, intern_capabilities(capabilities, bits)) for component, capabilities in get_component_capabilities(device)]
+        mask = 0
+        for _, component_mask in masks:
+            mask |= component_mask
+        # most devices only have main, so only the others are given their components
+        if len(masks) > 1:
+            components[len(rows)] = masks
+        rows.append((DEVICE, device['deviceId'], device['label'] or '', mask, mask & SUPPORTED_MASK))
+        device_rooms.append(device.get('roomId'))
+    for scene in scenes or []:
+        rows.append((SCENE, scene['sceneId'], scene['sceneName'] or '', 0, True))
+    for name in CONFIG_COMMANDS:
+        rows.append((CONFIG, name, name, 0, True))
+    labels = [label.replace(SEPARATOR, ' ') for _, _, label, _, _ in rows]
+    keys = [label.strip() for label in labels]
+    folded = [Workflow.fold_to_ascii(key).lower() for key in keys]
+    eligible = array('B', [bool(key and supported) for key, (_, _, _, _, supported) in zip(keys, rows)])
+    templates = [item_templates(row[0], row[1], label, row[3]) for row, label in zip(rows, labels)]
+    room_partitions = {}
+    for room in rooms or []:
+        room_partitions[room['roomId']] = {'name': room['name'], 'words': query_words(room['name']), 'positions': array('I')}
+    for pos, room in enumerate(device_rooms):
+        if room in room_partitions:
+            room_partitions[room]['positions'].append(pos)
+    # words of device and scene labels for typo-tolerant matching
+    atoms = sorted(set(atom for pos, value in enumerate(folded) if eligible[pos] and CONFIG != rows[pos][0] for atom in split_on_delimiters(value) if atom))
+    return {
+        'version': INDEX_VERSION,
+        'updated': time.time(),
+        'capabilities': bits,
+        'device_count': len(device_rooms),
+        'types': array('B', [row[0] for row in rows]),
+        'ids': pack_column([row[1] for row in rows]),
+        'labels': pack_column(labels),
+        'lower': pack_column([key.lower() for key in keys]),
+        'folded': pack_column(folded),
+        'masks': array('Q', [row[3] for row in rows]),
+        'components': components,
+        'eligible': eligible,
+        'icons': array('B', [template[0] for template in templates]),
+        'args': pack_column([template[1] for template in templates]),
+        'subtitles': pack_column([template[2] for template in templates]),
+        'rooms': room_partitions,
+        'atoms': atoms,
+        'atom_tree': build_bk_tree(atoms)
+    }
+
+def store_index(wf, devices, scenes, rooms):
+    """Build and store the search index, stamped with the generation of the devices it was built from
+
+    devices may be any iterable - it is only walked once.
+    """
+    generation = get_stored_data(wf, DEVICES_GENERATION)
+    index = build_index(devices, scenes, rooms)
+    index['generation'] = generation
+    wf.store_data('index', index)
+    return index
+
+def load_index(wf):
+    """Load the search index, rebuilding it from stored devices and scenes if missing, outdated or built from other devices"""
+    index = get_stored_data(wf, 'index')
+    if not index or INDEX_VERSION != index.get('version') or get_stored_data(wf, DEVICES_GENERATION) != index.get('generation'):
+        wf.logger.debug("search index missing or outdated - rebuilding")
+        index = store_index(wf, iter_stored_data(wf, 'devices'), get_stored_data(wf, 'scenes'), get_stored_data(wf, 'rooms'))
+    return index
+
+def word_score(value, word):
+    """Score a single lower-cased query word against a lower-cased (and maybe folded) search key.
+
+    Mirrors Workflow._filter_item with MATCH_STARTSWITH | MATCH_ATOM | MATCH_SUBSTRING.
+
+    """
+    # every rule needs word somewhere in value, so this is the only check most entities get
+    if word not in value:
+        return 0
+    if value.startswith(word) or word in split_on_delimiters(value):
+        return 100.0 - (len(value) / len(word))
+    return 90.0 - (len(value) / len(word))
+
+def query_words(query):
+    return [s.strip().lower() for s in query.split(' ') if s.strip()] if query else []
+
+def rank_splits(wf, query, index, candidates=None, drops=0, min_score=80, survivors=None, hot=(), everything=None):
+    """Rank entities against the query and the query minus its last 1..drops words in one sweep.
+
+    Returns a list with one ranked list of positions per number of dropped words, with all
+    entity types merged. Config commands are scored on the first word of the query only. Only
+    the positions in candidates are scored - by default, those whose search key contains the
+    first word, found with str.find over the packed column. An empty (sub)query matches every
+    position in everything - by default every candidate, or every device without candidates. If
+    survivors is a list, every position matching all words of the shortest non-empty split is
+    appended to it, whatever its score. Positions in hot win ties.
+
+    """
+    words = query_words(query)
+    lengths = [max(len(words) - drop, 0) for drop in range(drops + 1)]
+    longest = max(lengths)
+    fold = wf.settings.get('__workflow_diacritic_folding', True)
+    folds = [fold and isascii(word) for word in words]
+    scored = candidates
+    if longest and scored is None:
+        scored = find_positions(index, 'folded' if folds[0] else 'lower', words[0])
+    types = index['types']
+    eligible = index['eligible']
+    results = [[] for _ in lengths]
+    for pos in scored if longest else []:
+        if not eligible[pos]:
+            continue
+        config = CONFIG == types[pos]
+        lower = column_value(index, 'lower', pos)
+        folded = column_value(index, 'folded', pos)
+        # cumulative score of the first i+1 words - stop at the first word that does not match
+        score = 0
+        scores = []
+        for word, fold_word in zip(words[:1 if config else longest], folds):
+            word_score_ = word_score(folded if fold_word else lower, word)
+            if not word_score_:
+                break
+            score += word_score_
+            scores.append(score)
+        if survivors is not None and len(scores) >= (1 if config else max(lengths[-1], 1)):
+            survivors.append(pos)
+        for i, length in enumerate(lengths):
+            if config:
+                length = min(length, 1)
+            if length and len(scores) >= length and scores[length - 1] > min_score:
+                results[i].append(((100.0 / scores[length - 1], pos not in hot, lower), pos))
+    for i, length in enumerate(lengths):
+        if not length:
+            if everything is None:
+                everything = candidates if candidates is not None else range(index['device_count'])
+            results[i] = list(everything)
+        else:
+            results[i].sort(key=lambda x: x[0])
+            results[i] = [x[1] for x in results[i]]
+    return results
+
+def edit_distance(a, b):
+    """Levenshtein distance between two strings"""
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+def build_bk_tree(words):
+    """Build a BK-tree of words as nested (word, {distance: child}) tuples"""
+    tree = None
+    for word in words:
+        if tree is None:
+            tree = (word, {})
+            continue
+        node = tree
+        while True:
+            distance = edit_distance(word, node[0])
+            if distance not in node[1]:
+                node[1][distance] = (word, {})
+                break
+            node = node[1][distance]
+    return tree
+
+def bk_search(tree, word, tolerance):
+    """Return (distance, word) for every word in the tree within tolerance edits of word"""
+    results = []
+    nodes = [tree] if tree else []
+    while nodes:
+        node_word, children = nodes.pop()
+        distance = edit_distance(word, node_word)
+        if distance <= tolerance:
+            results.append((distance, node_word))
+        # triangle inequality - only subtrees at a similar distance can hold matches
+        for child_distance, child in children.items():
+            if distance - tolerance <= child_distance <= distance + tolerance:
+                nodes.append(child)
+    return results
+
+def typo_tolerance(word):
+    """Edits allowed for a query word - short words are too ambiguous to correct"""
+    return max(0, min(2, (len(word) - 2) // 2))
+
+def correct_words(index, words, keep=()):
+    """Replace query words that are not the start of any label word with the closest label word.
+
+    Used as a fallback when the exact matching rules return nothing. Words in keep, such as
+    command names and params, are left alone.
+
+    """
+    atoms = index['atoms']
+    corrected = []
+    for word in words:
+        lower = word.lower()
+        tolerance = typo_tolerance(lower)
+        i = bisect_left(atoms, lower)
+        if lower in keep or not tolerance or (i < len(atoms) and atoms[i].startswith(lower)):
+            corrected.append(word)
+            continue
+        matches = bk_search(index['atom_tree'], lower, tolerance)
+        # fewest edits first, preferring words with the same first letter
+        matches.sort(key=lambda x: (x[0], x[1][0] != lower[0], x[1]))
+        corrected.append(matches[0][1] if matches else word)
+    return corrected
+
+def match_room(index, words):
+    """Return the id of the room whose name the query starts with and the number of words it spans.
+
+    The room name must be followed by at least one more word. The longest matching name wins.
+
+    """
+    room, skip = None, 0
+    for room_id, partition in index['rooms'].items():
+        length = len(partition['words'])
+        if skip < length < len(words) and words[:length] == partition['words']:
+            room, skip = room_id, length
+    return room, skip
+
+def search_index(wf, query, index, drops=0, hot=()):
+    """Rank the index against the query and its splits, narrowed by room and by the previous query.
+
+    If the query starts with a room name, the rest of the query is scored against only the
+    devices in that room, falling back to the whole index if nothing in the room matches.
+    Scenes and config commands are in no room, so they are still scored against the whole
+    query and listed after the devices in the room - their scores are for a longer query, so
+    they do not compare.
+
+    """
+    words = query_words(query)
+    room, skip = match_room(index, words)
+    if room:
+        results = search_candidates(wf, ' '.join(words), index, drops, room, skip, hot)
+        # splits with no words left match every device in the room, so only count the others
+        if any(result for drop, result in enumerate(results) if len(words) - skip - drop > 0):
+            wf.logger.debug("searching devices in room "+index['rooms'][room]['name'])
+            others = rank_splits(wf, ' '.join(words), index, range(index['device_count'], len(index['types'])), drops, hot=hot)
+            return [devices + other for devices, other in zip(results, others)]
+    return search_candidates(wf, ' '.join(words), index, drops, hot=hot)
+
+def search_candidates(wf, query, index, drops=0, room=None, skip=0, hot=()):
+    """rank_splits over only the entities that survived the previous query, if this query extends it.
+
+    Alfred runs the Script Filter once per keystroke, so the candidates matching the shortest
+    split are kept in the cache dir. Lengthening a word or adding words can only drop candidates
+    under the startswith/atom/substring rules, so the next keystroke rescores just those. With a
+    room, only its devices are candidates and the first skip words (the room name) are not scored.
+
+    """
+    key = (index['updated'], drops, wf.settings.get('__workflow_diacritic_folding', True), room)
+    candidates = index['rooms'][room]['positions'] if room else None
+    cached = wf.cached_data('search_candidates', max_age=0)
+    if cached and cached['key'] == key and cached['positions'] is not None and query.startswith(cached['query']):
+        candidates = cached['positions']
+        wf.logger.debug("narrowed search to "+str(len(candidates))+" of "+str(len(index['types']))+" entities")
+    survivors = array('I')
+    rest = ' '.join(query_words(query)[skip:])
+    # empty splits match every device (in the room) - not just the narrowed candidates
+    everything = index['rooms'][room]['positions'] if room else range(index['device_count'])
+    results = rank_splits(wf, rest, index, candidates, drops, survivors=survivors, hot=hot, everything=everything)
+    # every non-empty split needs the first word, so its survivors narrow the next keystroke
+    positions = survivors if query_words(rest) else None
+    wf.cache_data('search_candidates', {'key': key, 'query': query, 'positions': positions})
+    return results
+
+def record_usage(wf, uid):
+    """Count a command run on a device or scene and refresh the stored hot set"""
+    now = time.time()
+    usage = get_stored_data(wf, 'usage') or {}
+    score, last = usage.get(uid, (0, now))
+    usage[uid] = (score * 0.5 ** ((now - last) / USAGE_HALF_LIFE) + 1, now)
+    wf.store_data('usage', usage)
+    decayed = {uid: score * 0.5 ** ((now - last) / USAGE_HALF_LIFE) for uid, (score, last) in usage.items()}
+    wf.store_data('hot', sorted(decayed, key=decayed.get, reverse=True)[:HOT_SET_SIZE])
+
+def load_hot_set(wf, index):
+    """Positions in the index of the most used devices and scenes, most used first"""
+    hot = []
+    for uid in get_stored_data(wf, 'hot') or []:
+        pos = position_of(index, 'ids', uid)
+        if pos is not None and CONFIG != index['types'][pos]:
+            hot.append(pos)
+    return hot
+
+def match_hot(wf, index, hot, words):
+    """Find a hot device whose label is exactly the query.
+
+    Returns (device position, ranked positions) or (None, []). An exact label match is what
+    the full index search would rank first among the devices, and drop all other devices for,
+    so only the scenes and config commands are still scored. A query starting with a room name
+    is left to the index search, which scores only the rest of it, as is a query with words
+    past a label - whether those are a command depends on the devices the whole query matches.
+
+    """
+    query = ' '.join(words)
+    if not words or match_room(index, query_words(query))[0]:
+        return None, []
+    for pos in hot:
+        if DEVICE == index['types'][pos] and index['eligible'][pos] and column_value(index, 'lower', pos) == query.lower():
+            others = range(index['device_count'], len(index['types']))
+            return pos, rank_splits(wf, query, index, candidates=[pos] + list(others), hot=hot)[0]
+    return None, []
@@ -0,0 +1,90 @@
+# encoding: utf-8
+
+from common import HEX_COLOR
+from index import build_bk_tree, bk_search
+
+# most edits a misspelt color name may be from a known one - as for label words, see typo_tolerance
+COLOR_TOLERANCE = 2
+
+def hex_to_lab(value):
+    """Convert an rgb hex color to CIE L*a*b* (D65), where euclidean distance tracks perceived difference"""
+    value = value.lstrip('#')
+    rgb = [int(value[i:i+2], 16) / 255.0 for i in (0, 2, 4)]
+    r, g, b = [((c + 0.055) / 1.055) ** 2.4 if c > 0.04045 else c / 12.92 for c in rgb]
+    xyz = [
+        (r * 0.4124 + g * 0.3576 + b * 0.1805) / 0.95047,
+        (r * 0.2126 + g * 0.7152 + b * 0.0722) / 1.0,
+        (r * 0.0193 + g * 0.1192 + b * 0.9505) / 1.08883
+    ]
+    fx, fy, fz = [t ** (1 / 3.0) if t > 0.008856 else 7.787 * t + 16 / 116.0 for t in xyz]
+    return (116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz))
+
+def build_kd_tree(points, depth=0):
+    """Build a k-d tree of (lab, name) points as nested (lab, name, left, right) tuples"""
+    if not points:
+        return None
+    axis = depth % 3
+    points = sorted(points, key=lambda x: x[0][axis])
+    middle = len(points) // 2
+    return (points[middle][0], points[middle][1], build_kd_tree(points[:middle], depth + 1), build_kd_tree(points[middle + 1:], depth + 1))
+
+def nearest_in_kd_tree(tree, lab):
+    """Return (squared distance, name) of the point in the tree closest to lab"""
+    best = (float('inf'), None)
+    nodes = [(tree, 0)]
+    while nodes:
+        node, depth = nodes.pop()
+        if node is None:
+            continue
+        point, name, left, right = node
+        distance = sum((a - b) ** 2 for a, b in zip(point, lab))
+        if distance < best[0]:
+            best = (distance, name)
+        axis = depth % 3
+        delta = lab[axis] - point[axis]
+        near, far = (left, right) if delta < 0 else (right, left)
+        # the far side can only hold a closer point if the splitting plane is closer than the best so far
+        if delta ** 2 < best[0]:
+            nodes.append((far, depth + 1))
+        nodes.append((near, depth + 1))
+    return best
+
+def build_color_index(colors):
+    """Build the nearest color lookups for the colors store - run at st update time"""
+    points = []
+    for name, value in (colors or {}).items():
+        try:
+            points.append((hex_to_lab(value), name))
+        except ValueError:
+            continue
+    return {'tree': build_kd_tree(points), 'names': build_bk_tree(sorted(colors or {}))}
+
+def nearest_color_name(color_index, value):
+    """Name of the named color closest to an rgb hex value"""
+    if not color_index or not color_index['tree']:
+        return ''
+    return nearest_in_kd_tree(color_index['tree'], hex_to_lab(value))[1]
+
+def closest_color_names(color_index, name, limit=5):
+    """Color names fewest edits away from a name that is not in the colors store"""
+    if not color_index or not color_index['names']:
+        return []
+    name = name.lower().replace(' ','')
+    # widen the search until something is found - the tree only visits nearby subtrees, as long
+    # as the tolerance stays small
+    for tolerance in range(1, max(min(len(name) // 2, COLOR_TOLERANCE), 1) + 1):
+        matches = bk_search(color_index['names'], name, tolerance)
+        if matches:
+            return [x[1] for x in sorted(matches)[:limit]]
+    return []
+
+def get_color(name, colors, color_index=None):
+    name = name.lower().replace(' ','')
+    if HEX_COLOR.match(name):
+        return '#'+name.upper()
+    elif name in colors:
+        return colors[name].upper()
+    closest = closest_color_names(color_index, name, 1)
+    if closest:
+        return colors[closest[0]].upper()
+    return ''
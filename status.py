@@ -0,0 +1,230 @@
+# encoding: utf-8
+
+import time
+import queue
+import threading
+from workflow.background import run_in_background, is_running
+from common import st_api
+
+# statuses are served from the cache dir - once older than this they are refreshed in the background
+STATUS_TTL = 60
+# seconds until Alfred reruns the Script Filter to pick up refreshed statuses
+STATUS_RERUN = 1
+
+# statuses of the first few devices in a result list are fetched at once, giving up on the
+# ones that have not arrived by the deadline, or when the latency budget of the run is spent,
+# so Alfred is never kept waiting
+STATUS_FETCH_LIMIT = 6
+STATUS_WORKERS = 4
+STATUS_DEADLINE = 0.8
+STATUS_PENDING = u'  ⏳ status pending'
+
+# speculative fetches of the status of a device that is likely to be picked, per minute
+PREFETCH_BUDGET = 6
+
+def load_statuses(wf):
+    """Cached statuses as {device uid: (time fetched, status)}"""
+    return wf.cached_data('statuses', max_age=0) or {}
+
+def store_statuses(wf, fetched):
+    """Add freshly fetched {device uid: status} to the status cache"""
+    statuses = load_statuses(wf)
+    now = time.time()
+    for uid, status in fetched.items():
+        statuses[uid] = (now, status)
+    wf.cache_data('statuses', statuses)
+
+def refresh_command(wf, uids):
+    return ['/usr/bin/python3', wf.workflowfile('command.py'), '--refresh-status'] + list(uids)
+
+def refresh_statuses(wf, uids):
+    """Fetch the statuses of uids into the status cache in a background process and have Alfred rerun
+
+    Alfred only reruns while a refresh is running, so it is not kept rerunning once it is done.
+    The refresh is launched without waiting for its Python to start.
+    """
+    wf.logger.debug("refreshing statuses of "+str(len(uids))+" devices in the background")
+    started = run_in_background('statuses', refresh_command(wf, uids), wait=False) is not None
+    if started or is_running('statuses'):
+        wf.rerun = STATUS_RERUN
+
+def fetch_statuses(wf, api_key, uids):
+    """Fetch the statuses of uids into the status cache.
+
+    A failed fetch is cached as an empty status, so it is not tried again before STATUS_TTL has
+    passed and does not lose the statuses fetched for the other devices.
+    """
+    fetched = {}
+    for uid in uids:
+        try:
+            fetched[uid] = fetch_device_status(wf, api_key, uid)
+        except Exception as e:
+            wf.logger.debug("fetch_statuses: failed for "+uid+": "+str(e))
+            fetched[uid] = ''
+    store_statuses(wf, fetched)
+
+def prefetch_status(wf, uid):
+    """Fetch the status of a device that is likely to be picked into the status cache in the background.
+
+    Skipped if the latency budget of the run is spent, its cached status is still fresh, a
+    prefetch is already running or the budget of PREFETCH_BUDGET prefetches a minute is spent.
+    The prefetch is launched without waiting for its Python to start. Alfred is not asked to
+    rerun.
+
+    """
+    if wf.budget_remaining() == 0:
+        wf.logger.debug("no latency budget left to prefetch")
+        return False
+    now = time.time()
+    cached = load_statuses(wf)
+    if uid in cached and now - cached[uid][0] <= STATUS_TTL or is_running('prefetch'):
+        return False
+    recent = [started for started in wf.cached_data('prefetches', max_age=0) or [] if now - started < 60]
+    if len(recent) >= PREFETCH_BUDGET:
+        wf.logger.debug("prefetch budget spent")
+        return False
+    wf.cache_data('prefetches', recent + [now])
+    wf.logger.debug("prefetching status of "+uid)
+    run_in_background('prefetch', refresh_command(wf, [uid]), wait=False)
+    return True
+
+def device_statuses(wf, api_key, devices):
+    """Statuses of the first STATUS_FETCH_LIMIT devices - stale while revalidate.
+
+    Cached statuses are returned straight away, and if older than STATUS_TTL refreshed in the
+    background. Devices with no cached status are fetched by a few threads at the same time.
+    Those that did not arrive within STATUS_DEADLINE seconds, or what is left of the latency
+    budget of the run, are left out and fetched in the background too - the threads are
+    daemons, so requests still running then do not hold up exiting. While a background refresh
+    is running, missing statuses are left to it. A failed fetch gives an empty status.
+
+    """
+    cached = load_statuses(wf)
+    now = time.time()
+    result = {}
+    refresh = []
+    pending = queue.Queue()
+    for device in devices[:STATUS_FETCH_LIMIT]:
+        if device['id'] in cached:
+            fetched_at, result[device['id']] = cached[device['id']]
+            if now - fetched_at > STATUS_TTL:
+                refresh.append(device['id'])
+        else:
+            pending.put(device)
+    deadline = time.time() + STATUS_DEADLINE
+    if wf.budget_remaining() is not None:
+        deadline = min(deadline, time.time() + wf.budget_remaining())
+    fetched = queue.Queue()
+    def worker():
+        while time.time() < deadline:
+            try:
+                device = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                # no retries inside the deadline - a failure is left to the background refresh
+                fetched.put((device['id'], fetch_device_status(wf, api_key, device['id'], retries=0)))
+            except Exception as e:
+                wf.logger.debug("device_statuses: failed for "+device['label']+": "+str(e))
+                fetched.put((device['id'], None))
+    count = 0 if is_running('statuses') or deadline <= time.time() else pending.qsize()
+    for _ in range(min(STATUS_WORKERS, count)):
+        threading.Thread(target=worker, daemon=True).start()
+    arrived = {}
+    for _ in range(count):
+        try:
+            uid, status = fetched.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            wf.logger.debug("device_statuses: deadline passed")
+            break
+        # failures are not cached, so they are tried again on the next keystroke
+        if status is not None:
+            arrived[uid] = status
+        result[uid] = status or ''
+    if arrived:
+        store_statuses(wf, arrived)
+    refresh += [device['id'] for device in devices[:STATUS_FETCH_LIMIT] if device['id'] not in result]
+    if refresh:
+        refresh_statuses(wf, refresh)
+    return result
+
+def device_status(wf, api_key, device):
+    """Status of a single device, see device_statuses"""
+    return device_statuses(wf, api_key, [device]).get(device['id'], STATUS_PENDING)
+
+def fetch_device_status(wf, api_key, device_uid, retries=None):
+    caps = {
+        'switch': {
+            'tag': 'switch',
+            'icon': u'🎚'
+        },
+        'switchLevel': {
+            'tag': 'level',
+            'icon': u'💡'
+        },
+        'lock': {
+            'tag': 'lock',
+            'icon': u'🔒'
+        },
+        'battery': {
+            'tag': 'battery',
+            'icon': u'🔋'
+        },
+        'colorControl': {
+            'tag': 'color',
+            'icon': u'🎨'
+        },
+        'windowShade': {
+            'tag': 'windowShade',
+            'icon': u'🪟'
+        },
+        'windowShadeLevel': {
+            'tag': 'shadeLevel',
+            'icon': u'🌒'
+        },
+        'contactSensor': {
+            'tag': 'contact',
+            'icon': u'🔓'
+        },
+        'thermostat': [
+        {
+            'tag': 'heatingSetpoint',
+            'icon': u'🔥'
+        },
+        {
+            'tag': 'coolingSetpoint',
+            'icon': u'❄️'
+        },
+        {
+            'tag': 'thermostatOperatingState',
+            'icon': u'🏃🏻‍♀️'
+        },
+        {
+            'tag': 'temperature',
+            'icon': u'🌡'
+        },
+        {
+            'tag': 'thermostatFanMode',
+            'icon': u'💨'
+        },
+        {
+            'tag': 'thermostatMode',
+            'icon': u'😰'
+        }
+        ]
+    }
+    subtitle = ''
+    status = st_api(wf, api_key, '/devices/'+device_uid+'/status', retries=retries)
+    if status and 'components' in status and 'main' in status['components']:
+        detail = status['components']['main']
+        for cap in caps:
+            if not cap in detail: continue
+            metas = caps[cap]
+            if not isinstance(metas, list):
+                metas = [metas]
+            for meta in metas:
+                tag = meta['tag']
+                if not tag in detail[cap]: continue
+                wf.logger.debug(device_uid+' '+cap+' '+tag)
+                subtitle += u'  '+meta['icon']+' '+str(detail[cap][tag]['value'])+(detail[cap][tag]['unit'] if 'unit' in detail[cap][tag] else '')
+    return subtitle
@@ -0,0 +1,366 @@
+"""Asyncio counterpart of :mod:`workflow.web`.
+
+The functions here take the same arguments as their :mod:`workflow.web`
+namesakes and return the same :class:`~workflow.web.Response`, but are
+coroutines that run on the event loop instead of blocking it:
+
+>>> r = await aio.get('https://example.com/data.json')
+>>> r.status_code
+200
+>>> r.json()
+
+Requests speak HTTP/1.1 over :func:`asyncio.open_connection` and reuse
+keep-alive connections per host and event loop. Responses are always
+read in full, proxies are not used, and ``auth`` is sent as a
+pre-emptive Basic ``Authorization`` header.
+
+"""
+
+import asyncio
+import base64
+import email.parser
+import http.client
+import io
+import ssl
+import urllib.error
+import urllib.parse
+import urllib.response
+import weakref
+
+from . import web
+
+# Idle keep-alive connections kept open per host
+MAX_IDLE_CONNECTIONS = 4
+
+# Redirects followed before giving up
+MAX_REDIRECTS = 10
+
+# Idle connections of each event loop, as {(scheme, host, port): [(reader, writer)]}
+_pools = weakref.WeakKeyDictionary()
+
+
+class Response(web.Response):
+    """:class:`workflow.web.Response` for a reply read by :func:`request`.
+
+    Only the constructor differs: the reply has already been read, so
+    nothing is requested here.
+
+    """
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, req, status, reason, headers, body):
+        """Create a new :class:`Response` for :class:`~workflow.web.Request` ``req``.
+
+        :param status: HTTP status code
+        :type status: int
+        :param reason: HTTP reason phrase
+        :type reason: str
+        :param headers: response headers
+        :type headers: :class:`http.client.HTTPMessage`
+        :param body: response body as received
+        :type body: bytes
+
+        """
+        self.request = req
+        self._stream = False
+        self.url = req.get_full_url()
+        self.raw = None
+        self._encoding = None
+        self.error = None
+        self.status_code = status
+        self.reason = web.RESPONSES.get(status)
+        self.headers = web.CaseInsensitiveDictionary()
+        self._content = None
+        self._content_loaded = False
+        self._gzipped = False
+        self.from_cache = False
+
+        if not 200 <= status < 300:
+            self.error = urllib.error.HTTPError(
+                self.url, status, reason, headers, io.BytesIO(body)
+            )
+            return
+
+        self.raw = urllib.response.addinfourl(io.BytesIO(body), headers, self.url, status)
+        self.transfer_encoding = headers.get_content_charset()
+        self.mimetype = headers.get("content-type")
+
+        for key in list(headers.keys()):
+            self.headers[key.lower()] = headers.get(key)
+
+        if "gzip" in headers.get("content-encoding", "") or "gzip" in headers.get(
+            "transfer-encoding", ""
+        ):
+            self._gzipped = True
+
+
+async def request(
+    method,
+    url,
+    params=None,
+    data=None,
+    json_data=None,
+    headers=None,
+    files=None,
+    auth=None,
+    timeout=60,
+    allow_redirects=False,
+):
+    """Make an HTTP(S) request. Arguments as for :func:`workflow.web.request`.
+
+    ``timeout`` limits the whole request, redirects included. A request
+    that times out raises :class:`asyncio.TimeoutError`, and one that
+    cannot connect raises :class:`urllib.error.URLError`.
+
+    :returns: Response object
+    :rtype: :class:`Response`
+
+    """
+    url, data, headers = web._prepare_request(  # pylint: disable=protected-access
+        url, params, data, json_data, headers, files
+    )
+
+    if auth is not None:
+        username, password = auth
+        token = base64.b64encode(f"{username}:{password}".encode("utf-8"))
+        headers["Authorization"] = "Basic " + token.decode("ascii")
+
+    return await asyncio.wait_for(
+        _request(method.upper(), url, data, headers, allow_redirects), timeout
+    )
+
+
+async def get(url, params=None, headers=None, auth=None, timeout=60, allow_redirects=True):
+    """Make a GET request. Arguments as for :func:`request`.
+
+    :returns: :class:`Response` instance
+
+    """
+    return await request(
+        "GET",
+        url,
+        params,
+        headers=headers,
+        auth=auth,
+        timeout=timeout,
+        allow_redirects=allow_redirects,
+    )
+
+
+async def delete(
+    url, params=None, data=None, headers=None, auth=None, timeout=60, allow_redirects=True
+):
+    """Make a DELETE request. Arguments as for :func:`request`.
+
+    :returns: :class:`Response` instance
+
+    """
+    return await request(
+        "DELETE",
+        url,
+        params,
+        data,
+        headers=headers,
+        auth=auth,
+        timeout=timeout,
+        allow_redirects=allow_redirects,
+    )
+
+
+async def post(
+    url,
+    params=None,
+    data=None,
+    json_data=None,
+    headers=None,
+    files=None,
+    auth=None,
+    timeout=60,
+    allow_redirects=False,
+):
+    """Make a POST request. Arguments as for :func:`request`.
+
+    :returns: :class:`Response` instance
+
+    """
+    return await request(
+        "POST", url, params, data, json_data, headers, files, auth, timeout, allow_redirects
+    )
+
+
+async def put(
+    url,
+    params=None,
+    data=None,
+    headers=None,
+    files=None,
+    auth=None,
+    timeout=60,
+    allow_redirects=False,
+):
+    """Make a PUT request. Arguments as for :func:`request`.
+
+    :returns: :class:`Response` instance
+
+    """
+    return await request(
+        "PUT", url, params, data, None, headers, files, auth, timeout, allow_redirects
+    )
+
+
+async def close_all():
+    """Close the idle connections of the running event loop."""
+    pool = _pools.pop(asyncio.get_running_loop(), {})
+    for connections in pool.values():
+        for _, writer in connections:
+            writer.close()
+
+
+async def _request(method, url, data, headers, allow_redirects):
+    """Send a prepared request, following redirects if allowed."""
+    for _ in range(MAX_REDIRECTS + 1):
+        req = web.Request(url, data, headers, method=method)
+        status, reason, response_headers, body = await _exchange(req)
+
+        location = response_headers.get("location")
+        if not allow_redirects or status not in (301, 302, 303, 307, 308) or not location:
+            return Response(req, status, reason, response_headers, body)
+
+        url = urllib.parse.urljoin(url, location)
+        if status == 303 or (status in (301, 302) and method == "POST"):
+            method, data = "GET", None
+            headers = web.CaseInsensitiveDictionary(
+                [(k, v) for k, v in headers.items() if k.lower() != "content-type"]
+            )
+
+    raise urllib.error.HTTPError(url, status, "too many redirects", response_headers, None)
+
+
+async def _exchange(req):
+    """Send ``req`` and read the reply on a pooled connection.
+
+    :returns: ``(status, reason, headers, body)``
+    :rtype: 4-tuple
+
+    """
+    parts = urllib.parse.urlsplit(req.get_full_url())
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise urllib.error.URLError(f"unsupported URL: {req.get_full_url()!r}")
+
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    key = (parts.scheme, parts.hostname, port)
+    pool = _pools.setdefault(asyncio.get_running_loop(), {})
+
+    lines = [f"{req.get_method()} {req.selector} HTTP/1.1", f"Host: {req.host}"]
+    headers = {name.title(): value for name, value in req.header_items()}
+    headers["Connection"] = "keep-alive"
+    if req.data is not None or req.get_method() in ("POST", "PUT"):
+        headers["Content-Length"] = str(len(req.data or b""))
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    message = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (req.data or b"")
+
+    while True:
+        reused = bool(pool.get(key))
+        if reused:
+            reader, writer = pool[key].pop()
+            # The server closed this idle connection
+            if reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+        else:
+            try:
+                reader, writer = await asyncio.open_connection(
+                    parts.hostname,
+                    port,
+                    ssl=ssl.create_default_context() if parts.scheme == "https" else None,
+                )
+            except OSError as err:
+                raise urllib.error.URLError(err) from err
+
+        sent = False
+        try:
+            writer.write(message)
+            await writer.drain()
+            sent = True
+            status, reason, headers, body, keep_alive = await _read_reply(
+                reader, req.get_method()
+            )
+        except (OSError, asyncio.IncompleteReadError, http.client.HTTPException) as err:
+            writer.close()
+            # The server dropped an idle connection: retry on a new one, unless
+            # the request may have reached it and is not safe to send twice
+            if (
+                reused
+                and isinstance(
+                    err,
+                    (ConnectionError, asyncio.IncompleteReadError, http.client.RemoteDisconnected),
+                )
+                and (not sent or req.get_method() in web.IDEMPOTENT_METHODS)
+            ):
+                continue
+            raise urllib.error.URLError(err) from err
+        except BaseException:
+            # Cancelled part way through a reply: the connection is unusable
+            writer.close()
+            raise
+
+        connections = pool.setdefault(key, [])
+        if keep_alive and len(connections) < MAX_IDLE_CONNECTIONS:
+            connections.append((reader, writer))
+        else:
+            writer.close()
+
+        return status, reason, headers, body
+
+
+async def _read_reply(reader, method):
+    """Read a reply from ``reader``.
+
+    :returns: ``(status, reason, headers, body, keep_alive)``
+    :rtype: 5-tuple
+
+    """
+    line = await reader.readline()
+    if not line:
+        raise http.client.RemoteDisconnected("Remote end closed connection without response")
+
+    try:
+        version, status, reason = (line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+        status = int(status)
+    except ValueError as err:
+        raise http.client.BadStatusLine(line) from err
+
+    header_lines = []
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        header_lines.append(line.decode("latin-1"))
+    headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(
+        "".join(header_lines)
+    )
+
+    keep_alive = version == "HTTP/1.1" and "close" not in headers.get("connection", "").lower()
+
+    if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+        body = b""
+    elif "chunked" in headers.get("transfer-encoding", "").lower():
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";", 1)[0].strip() or b"0", 16)
+            if not size:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        # Skip trailers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        body = b"".join(chunks)
+    elif headers.get("content-length"):
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        # The body runs to the end of the connection
+        body = await reader.read()
+        keep_alive = False
+
+    return status, reason, headers, body, keep_alive
@@ -177,12 +177,14 @@ def kill(name, sig=signal.SIGTERM):
     return True
 
 
-def run_in_background(name, args, **kwargs):
+def run_in_background(name, args, wait=True, **kwargs):
     r"""Cache arguments then call this script again via :func:`subprocess.run`.
 
     :param name: name of job
     :type name: str
     :param args: arguments passed as first argument to :func:`subprocess.run`
+    :param wait: wait for ``background.py`` to fork (see below)
+    :type wait: bool
     :param \**kwargs: keyword arguments to :func:`subprocess.run`
     :returns: exit code of sub-process
     :rtype: int
@@ -194,7 +196,9 @@ def run_in_background(name, args, **kwargs):
 
     This function will return as soon as the ``background.py`` subprocess has
     forked, returning the exit code of *that* process (i.e. not of the command
-    you're trying to run).
+    you're trying to run). Starting Python takes a while, so with
+    ``wait=False`` it returns ``0`` straight away instead. :func:`is_running`
+    only sees the job once it has forked.
 
     If that process fails, an error will be written to the log file.
 
@@ -216,6 +220,11 @@ def run_in_background(name, args, **kwargs):
     # Call this script
     cmd = ["/usr/bin/python3", "-m", "workflow.background", name]
     wf.logger.debug("[%s] passing job to background runner: %r", name, cmd)
+    if not wait:
+        subprocess.Popen(cmd, start_new_session=True)  # pylint: disable=consider-using-with
+        wf.logger.debug("[%s] background job starting", name)
+        return 0
+
     retcode = subprocess.run(cmd, check=True).returncode
 
     if retcode:  # pragma: no cover
@@ -423,7 +423,8 @@ def get_downloads(repo):
 
     def _fetch():
         wf.logger.info("retrieving releases for %r ...", repo)
-        r = web.get(url)
+        # Revalidated releases cost a 304, which GitHub does not count against the rate limit
+        r = web.get(url, cache=wf.cachefile("http"))
         r.raise_for_status()
         return r.content
 
@@ -1,17 +1,24 @@
 """Lightweight HTTP library with a requests-like interface."""
 
 import codecs
+import functools
+import hashlib
+import http.client
 import json
 import mimetypes
 import os
 import re
 import secrets
+import select
 import socket
 import string
+import threading
+import time
 import unicodedata
 import urllib.request
 import urllib.parse
 import urllib.error
+import urllib.response
 import zlib
 
 # pylint: disable=consider-using-with
@@ -21,6 +28,12 @@ __version__ = open(
 
 USER_AGENT = f"Alpynist/{__version__}"
 
+# Idle keep-alive connections kept open per host
+MAX_IDLE_CONNECTIONS = 4
+
+# Methods that may be sent again when a reused connection fails before the reply
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE")
+
 # Valid characters for multipart form data boundaries
 BOUNDARY_CHARS = string.digits + string.ascii_letters
 
@@ -77,6 +90,159 @@ class NoRedirectHandler(urllib.request.HTTPRedirectHandler):
         return None
 
 
+class PooledResponse(http.client.HTTPResponse):
+    """:class:`http.client.HTTPResponse` that hands its connection back to the pool.
+
+    The connection can only carry another request once this response's
+    body has been read to the end. ``_close_conn`` is also called when the
+    response is closed or garbage-collected early, and then the connection
+    is closed instead.
+
+    """
+
+    release = None
+    drained = False
+
+    def _read_and_discard_trailer(self):
+        super()._read_and_discard_trailer()
+        # Only called after the last chunk
+        self.drained = True
+
+    def _close_conn(self):
+        super()._close_conn()
+        release, self.release = self.release, None
+        if release is not None:
+            release(not self.will_close and (self.drained or self.length == 0))
+
+
+class KeepAliveHandler(urllib.request.HTTPHandler, urllib.request.HTTPSHandler):
+    """Send HTTP(S) requests over persistent per-host connections.
+
+    :mod:`urllib` opens a new connection (and for HTTPS does a new TLS
+    handshake) for every request and sends ``Connection: close``. This
+    handler keeps HTTP/1.1 connections open after a response has been
+    read in full and reuses them for the next request to the same host.
+
+    Requests going through a proxy are left to :mod:`urllib`.
+
+    """
+
+    def __init__(self):
+        """Create a new :class:`KeepAliveHandler` with an empty pool."""
+        urllib.request.HTTPSHandler.__init__(self)
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def http_open(self, req):
+        return self._open(http.client.HTTPConnection, req)
+
+    def https_open(self, req):
+        return self._open(http.client.HTTPSConnection, req, context=self._context)
+
+    def close_all(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def _acquire(self, key):
+        while True:
+            with self._lock:
+                connections = self._idle.get(key)
+                if not connections:
+                    return None
+                conn = connections.pop()
+            # An idle connection has nothing to read unless the server closed it
+            try:
+                if conn.sock is not None and not select.select([conn.sock], [], [], 0)[0]:
+                    return conn
+            except (ValueError, OSError):  # socket already closed
+                pass
+            conn.close()
+
+    def _release(self, key, conn, reusable):
+        if reusable and conn.sock is not None and conn.sock.fileno() >= 0:
+            with self._lock:
+                connections = self._idle.setdefault(key, [])
+                if len(connections) < MAX_IDLE_CONNECTIONS:
+                    connections.append(conn)
+                    return
+        conn.close()
+
+    def _open(self, http_class, req, **http_conn_args):
+        if req.has_proxy() or req._tunnel_host:  # pylint: disable=protected-access
+            return self.do_open(http_class, req, **http_conn_args)
+
+        host = req.host
+        if not host:
+            raise urllib.error.URLError("no host given")
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers["Connection"] = "keep-alive"
+        headers = {name.title(): val for name, val in headers.items()}
+
+        key = (http_class, host)
+        while True:
+            conn = self._acquire(key)
+            reused = conn is not None
+            if not reused:
+                conn = http_class(host, timeout=req.timeout, **http_conn_args)
+                conn.response_class = PooledResponse
+                conn.set_debuglevel(self._debuglevel)
+            elif conn.sock is not None:
+                timeout = req.timeout
+                if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:  # pylint: disable=protected-access
+                    timeout = socket.getdefaulttimeout()
+                conn.sock.settimeout(timeout)
+
+            sent = False
+            try:
+                conn.request(
+                    req.get_method(),
+                    req.selector,
+                    req.data,
+                    headers,
+                    encode_chunked=req.has_header("Transfer-encoding"),
+                )
+                sent = True
+                r = conn.getresponse()
+            except OSError as err:  # timeout error
+                conn.close()
+                # The server dropped an idle connection: retry on a new one, unless
+                # the request may have reached it and is not safe to send twice
+                if (
+                    reused
+                    and isinstance(err, (ConnectionResetError, BrokenPipeError))
+                    and (not sent or req.get_method() in IDEMPOTENT_METHODS)
+                ):
+                    continue
+                raise urllib.error.URLError(err) from err
+            except Exception:
+                conn.close()
+                raise
+            break
+
+        if r.will_close:
+            conn.close()
+        else:
+            # The response now owns the connection. Drop the connection's own
+            # reference to the response so that an unread response is freed
+            # (and its connection closed) as soon as the caller lets go of it.
+            conn._HTTPConnection__response = None  # pylint: disable=protected-access
+            r.release = functools.partial(self._release, key, conn)
+
+        r.url = req.get_full_url()
+        r.msg = r.reason
+        return r
+
+
+# Handler shared by all requests so connections outlive a single call
+_keep_alive = KeepAliveHandler()
+
+
 # Adapted from https://gist.github.com/babakness/3901174
 class CaseInsensitiveDictionary(dict):
     """Dictionary with caseless key search.
@@ -164,6 +330,146 @@ class Request(urllib.request.Request):
         return self._method.upper()
 
 
+class HTTPCache:
+    """On-disk cache of GET responses, revalidated with their validators.
+
+    A cached response is reused without a request while its
+    ``Cache-Control: max-age`` lasts. After that the request carries
+    ``If-None-Match`` / ``If-Modified-Since`` and a ``304 Not Modified``
+    reply is served from the cache. Responses with neither an ``ETag``
+    nor a ``Last-Modified`` header, or with ``Cache-Control: no-store``,
+    are not cached.
+
+    Each entry is a body file holding the bytes as received, plus a
+    ``.json`` file with its URL, status, headers and expiry.
+
+    """
+
+    def __init__(self, dirpath):
+        """Create a new :class:`HTTPCache` storing its files in ``dirpath``."""
+        self.dirpath = dirpath
+
+    def lookup(self, req):
+        """Return the cached entry for :class:`Request` ``req`` or ``None``."""
+        try:
+            with open(self._path(req) + ".json", encoding="utf-8") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, entry):
+        """Whether ``entry`` may be used without revalidating it."""
+        return entry.get("expires") is not None and entry["expires"] > time.time()
+
+    def add_validators(self, req, entry):
+        """Make ``req`` conditional on ``entry`` being out of date."""
+        headers = CaseInsensitiveDictionary(dict(entry["headers"]))
+        if "etag" in headers and not req.has_header("If-none-match"):
+            req.add_header("If-None-Match", headers["etag"])
+        if "last-modified" in headers and not req.has_header("If-modified-since"):
+            req.add_header("If-Modified-Since", headers["last-modified"])
+
+    def open(self, req, entry, headers=None):
+        """Return a file-like response for ``entry``.
+
+        ``headers`` of a ``304`` reply refresh the entry's expiry.
+
+        """
+        if headers is not None:
+            entry["expires"] = self._expires(headers) or entry.get("expires")
+            self._write_entry(req, entry)
+        message = http.client.HTTPMessage()
+        for key, value in entry["headers"]:
+            message[key] = value
+        # pylint: disable=consider-using-with
+        return urllib.response.addinfourl(
+            open(self._path(req), "rb"), message, entry["url"], entry["status"]
+        )
+
+    def store(self, req, raw):
+        """Return a file-like response that saves ``raw`` as it is read.
+
+        The entry is only written once the body has been read to the
+        end, so a partly read response never replaces a complete one.
+
+        """
+        headers = raw.info()
+        cache_control = headers.get("cache-control", "").lower()
+        if raw.getcode() != 200 or "no-store" in cache_control:
+            return raw
+        if not headers.get("etag") and not headers.get("last-modified"):
+            return raw
+
+        entry = {
+            "url": raw.geturl(),
+            "status": raw.getcode(),
+            "headers": list(headers.items()),
+            "expires": self._expires(headers),
+        }
+
+        def commit(path):
+            try:
+                os.unlink(self._path(req) + ".json")
+            except OSError:
+                pass
+            os.replace(path, self._path(req))
+            self._write_entry(req, entry)
+
+        if not os.path.exists(self.dirpath):
+            os.makedirs(self.dirpath)
+        return urllib.response.addinfourl(
+            _TeeReader(raw, self._path(req) + ".part", commit),
+            headers,
+            raw.geturl(),
+            raw.getcode(),
+        )
+
+    def _expires(self, headers):
+        cache_control = headers.get("cache-control", "").lower()
+        match = re.search(r"max-age=(\d+)", cache_control)
+        if not match or "no-cache" in cache_control:
+            return None
+        return time.time() + int(match.group(1))
+
+    def _path(self, req):
+        # Responses for different credentials are kept apart
+        key = req.get_full_url() + "\n" + (req.get_header("Authorization") or "")
+        return os.path.join(self.dirpath, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def _write_entry(self, req, entry):
+        path = self._path(req) + ".json"
+        with open(path + ".part", "w", encoding="utf-8") as fp:
+            json.dump(entry, fp)
+        os.replace(path + ".part", path)
+
+
+class _TeeReader:
+    """Copy everything read from ``raw`` to ``path``, calling ``commit(path)`` at the end."""
+
+    def __init__(self, raw, path, commit):
+        self.raw = raw
+        self.path = path
+        self._commit = commit
+        # pylint: disable=consider-using-with
+        self._file = open(path, "wb")
+
+    def read(self, size=-1):
+        data = self.raw.read() if size is None or size < 0 else self.raw.read(size)
+        if self._file is not None:
+            self._file.write(data)
+            if not data or size is None or size < 0:
+                self._file.close()
+                self._file = None
+                self._commit(self.path)
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self.raw.close()
+
+
 class Response:
     """
     Returned by :func:`request` / :func:`get` / :func:`post` functions.
@@ -183,12 +489,16 @@ class Response:
 
     """
 
-    def __init__(self, request, stream=False):  # pylint: disable=redefined-outer-name
+    def __init__(
+        self, request, stream=False, cache=None
+    ):  # pylint: disable=redefined-outer-name
         """Call `request` with :mod:`urllib` and process results.
 
         :param request: :class:`Request` instance
         :param stream: Whether to stream response or retrieve it all at once
         :type stream: bool
+        :param cache: Cache to serve and store the response with
+        :type cache: :class:`HTTPCache`
 
         """
         self.request = request
@@ -203,11 +513,11 @@ class Response:
         self._content = None
         self._content_loaded = False
         self._gzipped = False
+        self.from_cache = False
 
         # Execute query
         try:
-            # pylint: disable=consider-using-with
-            self.raw = urllib.request.urlopen(request)
+            self.raw = self._open(request, cache)
         except urllib.error.HTTPError as err:
             self.error = err
 
@@ -244,6 +554,28 @@ class Response:
             ):
                 self._gzipped = True
 
+    def _open(self, request, cache):  # pylint: disable=redefined-outer-name
+        """Open `request`, answering it from `cache` while fresh or not modified."""
+        entry = cache.lookup(request) if cache is not None else None
+        if entry is not None and cache.is_fresh(entry):
+            self.from_cache = True
+            return cache.open(request, entry)
+
+        if entry is not None:
+            cache.add_validators(request, entry)
+
+        try:
+            # pylint: disable=consider-using-with
+            raw = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as err:
+            if entry is None or err.code != 304:
+                raise
+            err.read()
+            self.from_cache = True
+            return cache.open(request, entry, err.headers)
+
+        return raw if cache is None else cache.store(request, raw)
+
     @property
     def stream(self):
         """Whether response is streamed.
@@ -460,6 +792,7 @@ def request(
     timeout=60,
     allow_redirects=False,
     stream=False,
+    cache=None,
 ):
     """Initiate an HTTP(S) request. Returns :class:`Response` object.
 
@@ -487,6 +820,8 @@ def request(
     :type allow_redirects: bool
     :param stream: Stream content instead of fetching it all at once.
     :type stream: bool
+    :param cache: directory of an :class:`HTTPCache` for GET responses
+    :type cache: str
     :returns: Response object
     :rtype: :class:`Response`
 
@@ -509,7 +844,7 @@ def request(
     socket.setdefaulttimeout(timeout)
 
     # Default handlers
-    openers = [urllib.request.ProxyHandler(urllib.request.getproxies())]
+    openers = [urllib.request.ProxyHandler(urllib.request.getproxies()), _keep_alive]
 
     if not allow_redirects:
         openers.append(NoRedirectHandler())
@@ -525,50 +860,11 @@ def request(
     opener = urllib.request.build_opener(*openers)
     urllib.request.install_opener(opener)
 
-    if not headers:
-        headers = CaseInsensitiveDictionary()
-    else:
-        headers = CaseInsensitiveDictionary(headers)
-
-    if "User-Agent" not in headers:
-        headers["User-Agent"] = USER_AGENT
-
-    # Accept gzip-encoded content
-    encodings = [s.strip() for s in headers.get("Accept-Encoding", "").split(",")]
-    if "gzip" not in encodings:
-        encodings.append("gzip")
-
-    headers["Accept-Encoding"] = ", ".join(encodings)
-
-    if files:
-        if not data:
-            data = {}
-
-        new_headers, data = _encode_multipart_formdata(data, files)
-        headers.update(new_headers)
-    elif data and isinstance(data, dict):
-        data = urllib.parse.urlencode(data)
-
-    if data:
-        data = data.encode("utf-8")
-
-    if json_data and not data:
-        data = json.dumps(json_data).encode("utf-8")
-        headers["Content-Type"] = "application/json"
-
-    if params:  # GET args (POST args are handled in _encode_multipart_formdata)
-        scheme, netloc, path, query, fragment = urllib.parse.urlsplit(url)
-
-        if query:  # Combine query string and `params`
-            url_params = urllib.parse.parse_qs(query)
-            # `params` take precedence over URL query string
-            url_params.update(params)
-            params = url_params
-
-        query = urllib.parse.urlencode(params, doseq=True)
-        url = urllib.parse.urlunsplit((scheme, netloc, path, query, fragment))
+    url, data, headers = _prepare_request(url, params, data, json_data, headers, files)
 
     req = Request(url, data, headers, method=method)
+    if cache is not None and method.upper() == "GET":
+        return Response(req, stream, HTTPCache(cache))
     return Response(req, stream)
 
 
@@ -580,6 +876,7 @@ def get(
     timeout=60,
     allow_redirects=True,
     stream=False,
+    cache=None,
 ):
     """Initiate a GET request. Arguments as for :func:`request`.
 
@@ -595,6 +892,7 @@ def get(
         timeout=timeout,
         allow_redirects=allow_redirects,
         stream=stream,
+        cache=cache,
     )
 
 
@@ -679,6 +977,61 @@ def put(
     )
 
 
+def _prepare_request(url, params, data, json_data, headers, files):
+    """Encode the body and query string of a request and set default headers.
+
+    Arguments as for :func:`request`.
+
+    :returns: ``(url, data, headers)`` with ``data`` as bytes or ``None``
+    :rtype: 3-tuple
+
+    """
+    if not headers:
+        headers = CaseInsensitiveDictionary()
+    else:
+        headers = CaseInsensitiveDictionary(headers)
+
+    if "User-Agent" not in headers:
+        headers["User-Agent"] = USER_AGENT
+
+    # Accept gzip-encoded content
+    encodings = [s.strip() for s in headers.get("Accept-Encoding", "").split(",")]
+    if "gzip" not in encodings:
+        encodings.append("gzip")
+
+    headers["Accept-Encoding"] = ", ".join(encodings)
+
+    if files:
+        if not data:
+            data = {}
+
+        new_headers, data = _encode_multipart_formdata(data, files)
+        headers.update(new_headers)
+    elif data and isinstance(data, dict):
+        data = urllib.parse.urlencode(data)
+
+    if data:
+        data = data.encode("utf-8")
+
+    if json_data and not data:
+        data = json.dumps(json_data).encode("utf-8")
+        headers["Content-Type"] = "application/json"
+
+    if params:  # GET args (POST args are handled in _encode_multipart_formdata)
+        scheme, netloc, path, query, fragment = urllib.parse.urlsplit(url)
+
+        if query:  # Combine query string and `params`
+            url_params = urllib.parse.parse_qs(query)
+            # `params` take precedence over URL query string
+            url_params.update(params)
+            params = url_params
+
+        query = urllib.parse.urlencode(params, doseq=True)
+        url = urllib.parse.urlunsplit((scheme, netloc, path, query, fragment))
+
+    return url, data, headers
+
+
 def _encode_multipart_formdata(fields, files):
     """Encode form data (``fields``) and ``files`` for POST request.
 
@@ -1154,6 +1154,10 @@ class Workflow:
         also be opened directly in a web browser with the ``workflow:help``
         :ref:`magic argument <magic-arguments>`.
     :type help_url: :class:`str`
+    :param latency_budget: seconds a run should take at most. Steps that
+        may be slow, like network requests, should check
+        :meth:`budget_remaining` and leave work for later when it runs out.
+    :type latency_budget: :class:`float`
     """
 
     item_class = Item
@@ -1167,6 +1171,7 @@ class Workflow:
         capture_args=True,
         libraries=None,
         help_url=None,
+        latency_budget=None,
     ):
         """Create new :class:`Workflow` object."""
         self._default_settings = default_settings or {}
@@ -1175,6 +1180,9 @@ class Workflow:
         self._normalization = normalization
         self._capture_args = capture_args
         self.help_url = help_url
+        self.latency_budget = latency_budget
+        # Start of the run, reset by `run()`
+        self._started = time.time()
         self._workflowdir = None
         self._settings_path = None
         self._settings = None
@@ -1212,6 +1220,7 @@ class Workflow:
         self._register_default_magic()
         self.variables = {}
         self._rerun = 0
+        self._feedback_cache = None
         # Get session ID from environment if present
         self._session_id = os.getenv("_WF_SESSION_ID") or None
 
@@ -2266,7 +2275,7 @@ class Workflow:
         output to Alfred.
 
         """
-        start = time.time()
+        start = self._started = time.time()
 
         # Write to debugger to ensure "real" output starts on a new line
         print(".", file=sys.stderr)
@@ -2325,6 +2334,18 @@ class Workflow:
 
         return 0
 
+    def budget_remaining(self):
+        """Seconds left of :attr:`latency_budget` since :meth:`run` started.
+
+        :returns: ``None`` if there is no budget, else the seconds left,
+            which is never negative
+        :rtype: ``float``
+
+        """
+        if self.latency_budget is None:
+            return None
+        return max(0.0, self.latency_budget - (time.time() - self._started))
+
     # Alfred feedback methods ------------------------------------------
 
     @property
@@ -2341,6 +2362,36 @@ class Workflow:
         """
         self._rerun = seconds
 
+    @property
+    def feedback_cache(self):
+        """Alfred 5 ``cache`` directive sent with the feedback, or ``None``."""
+        return self._feedback_cache
+
+    def set_feedback_cache(self, seconds, loosereload=False):
+        """Have Alfred cache the feedback of this Script Filter.
+
+        .. versionadded:: Alfred 5.0
+
+        Alfred shows the cached feedback instead of running the script
+        again until ``seconds`` have passed, so this is meant for Script
+        Filters with "Alfred filters results" turned on.
+
+        Args:
+            seconds (int): How long Alfred caches the feedback, between
+                5 seconds and a day.
+            loosereload (bool, optional): Have Alfred rerun the script in
+                the background whenever it shows the cached feedback, and
+                replace it with the new feedback.
+
+        Raises:
+            ValueError: Raised if ``seconds`` is out of range.
+        """
+        if not 5 <= seconds <= 86400:
+            raise ValueError(f"cache seconds must be between 5 and 86400: {seconds}")
+        self._feedback_cache = {"seconds": int(seconds)}
+        if loosereload:
+            self._feedback_cache["loosereload"] = True
+
     @property
     def session_id(self):
         """A unique session ID every time the user uses the workflow.
@@ -2507,6 +2558,9 @@ class Workflow:
         if self.rerun:
             obj_["rerun"] = self.rerun
 
+        if self._feedback_cache:
+            obj_["cache"] = self._feedback_cache
+
         return obj_
 
     def warn_empty(self, title, subtitle="", icon=None):